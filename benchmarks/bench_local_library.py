@@ -0,0 +1,76 @@
+"""Benchmark of the local library: full scan, incremental rescan and search
+
+Generates a folder of short tagged WAV files, so it runs offline and without FFmpeg.
+The rescan only stats the files. Their tags are not read again.
+
+Usage:
+    python benchmarks/bench_local_library.py [files]
+"""
+import random
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+from mutagen.id3 import TALB, TIT2, TPE1
+from mutagen.wave import WAVE
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import local_library as ll  # noqa: E402
+
+WORDS = ['love', 'night', 'fire', 'dream', 'heart', 'rain', 'summer', 'road', 'light', 'blue', 'river', 'gold', 'shadow', 'storm']
+ARTISTS = [f'Artist {index}' for index in range(200)]
+
+
+def create_library(folder: Path, files: int) -> None:
+    silence = bytes(4800 * 4)
+    for index in range(files):
+        album = folder / f'album_{index // 12:04d}'
+        album.mkdir(exist_ok=True)
+        file = album / f'{index:06d}.wav'
+        with wave.open(str(file), 'wb') as output:
+            output.setnchannels(2)
+            output.setsampwidth(2)
+            output.setframerate(48000)
+            output.writeframes(silence)
+        audio = WAVE(file)
+        audio.add_tags()
+        audio.tags.add(TIT2(encoding=3, text=' '.join(random.sample(WORDS, 3))))
+        audio.tags.add(TPE1(encoding=3, text=random.choice(ARTISTS)))
+        audio.tags.add(TALB(encoding=3, text=f'Album {index // 12}'))
+        audio.save()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as temporary:
+        folder = Path(temporary) / 'music'
+        folder.mkdir()
+        create_library(folder, files)
+        index_path = Path(temporary) / 'library.json.gz'
+
+        library = ll.LocalLibrary(folder, index_path)
+        result, elapsed = timed(library.scan)
+        print(f'Full scan:        {elapsed * 1000:8.1f} ms  {result}')
+        library.save()
+        print(f'Index size:       {index_path.stat().st_size / files:8.1f} bytes per track')
+
+        library = ll.LocalLibrary(folder, index_path)
+        result, elapsed = timed(library.scan)
+        print(f'Rescan (reload):  {elapsed * 1000:8.1f} ms  {result}')
+
+        queries = ['love', 'night fire', 'artist 12', 'blue riv', 'album 3', 'go']
+        _, elapsed = timed(lambda: [library.search(query) for _ in range(100) for query in queries])
+        print(f'Search:           {elapsed / (100 * len(queries)) * 1000:8.3f} ms per query')
+
+
+if __name__ == '__main__':
+    main()
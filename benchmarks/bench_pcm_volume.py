@@ -0,0 +1,58 @@
+"""Micro-benchmark of the per-frame CPU cost of the PCM volume
+
+Compares discord's PCMVolumeTransformer (audioop, one frame at a time) with the NumPy PCMFrameProcessor.
+
+Usage:
+    python benchmarks/bench_pcm_volume.py [seconds of audio]
+"""
+import io
+import sys
+import time
+from pathlib import Path
+
+import discord
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import pcm_processor as pcm  # noqa: E402
+
+
+class PipeLike(discord.AudioSource):
+    """Mimics FFmpegPCMAudio: a "read" method and a "_stdout" pipe"""
+
+    def __init__(self, data: bytes) -> None:
+        self._stdout = io.BufferedReader(io.BytesIO(data))
+
+    def read(self) -> bytes:
+        ret = self._stdout.read(pcm.FRAME_SIZE)
+        return ret if len(ret) == pcm.FRAME_SIZE else b''
+
+    def is_opus(self) -> bool:
+        return False
+
+
+def run(name: str, source, frames: int) -> float:
+    start = time.perf_counter()
+    while source.read():
+        pass
+    elapsed = time.perf_counter() - start
+    print(f'{name:<40} {elapsed / frames * 1e6:8.2f} us/frame')
+    return elapsed
+
+
+def main() -> None:
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    frames = int(seconds / pcm.FRAME_LENGTH)
+    rng = np.random.default_rng(0)
+    data = rng.integers(-20000, 20000, frames * pcm.FRAME_SAMPLES, dtype=np.int16).tobytes()
+    print(f'{frames} frames ({seconds}s of audio)')
+
+    run('read only (no volume)', PipeLike(data), frames)
+    baseline = run('PCMVolumeTransformer', discord.PCMVolumeTransformer(PipeLike(data), 0.5), frames)
+    processor = run('PCMFrameProcessor', pcm.PCMFrameProcessor(PipeLike(data), 0.5), frames)
+    run('PCMFrameProcessor (fades)', pcm.PCMFrameProcessor(PipeLike(data), 0.5, fade_in=seconds / 2, fade_out=seconds / 2, total_frames=frames), frames)
+    print(f'speedup: {baseline / processor:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Memory benchmark of the metadata kept per queued track
+
+Compares the full yt-dlp info dict, the slim info dict (without "formats" and the other heavy keys) and the TrackInfo record.
+The info dicts are synthetic, but shaped like the ones of a YouTube video.
+
+Usage:
+    python benchmarks/bench_track_memory.py [tracks]
+"""
+import gc
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import audio_cache as ac  # noqa: E402
+import track_info as ti  # noqa: E402
+
+UPLOADERS = [f'Uploader {index}' for index in range(50)]
+
+
+def fake_format(video_id: str, index: int) -> dict:
+    return {
+        'format_id': str(index),
+        'format_note': random.choice(['low', 'medium', '720p', '1080p']),
+        'ext': random.choice(['webm', 'm4a', 'mp4']),
+        'acodec': random.choice(['opus', 'mp4a.40.2', 'none']),
+        'vcodec': random.choice(['vp9', 'avc1.4d401f', 'none']),
+        'url': f'https://rr1---sn-abc.googlevideo.com/videoplayback?expire=1700000000&id={video_id}&itag={index}&{"x" * 900}',
+        'filesize': random.randint(10 ** 5, 10 ** 8),
+        'tbr': random.random() * 1000,
+        'abr': random.random() * 160,
+        'asr': 48000,
+        'fps': 30,
+        'width': 1280,
+        'height': 720,
+        'protocol': 'https',
+        'http_headers': {'User-Agent': 'Mozilla/5.0' + 'x' * 100, 'Accept': '*/*', 'Accept-Language': 'en-us,en;q=0.5'},
+        'downloader_options': {'http_chunk_size': 10485760},
+    }
+
+
+def fake_info(index: int) -> dict:
+    video_id = f'{index:011d}'
+    uploader = random.choice(UPLOADERS)
+    return {
+        'id': video_id,
+        'title': f'Some song title number {index}',
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'url': f'https://rr1---sn-abc.googlevideo.com/videoplayback?expire=1700000000&id={video_id}&{"x" * 900}',
+        'duration': random.randint(120, 600),
+        'uploader': uploader,
+        'uploader_url': f'https://www.youtube.com/@{uploader.replace(" ", "")}',
+        'channel': uploader,
+        'channel_url': f'https://www.youtube.com/@{uploader.replace(" ", "")}',
+        'upload_date': '20230101',
+        'thumbnail': f'https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg',
+        'description': 'A description. ' * 60,
+        'tags': [f'tag {tag}' for tag in range(15)],
+        'categories': ['Music'],
+        'view_count': random.randint(0, 10 ** 9),
+        'like_count': random.randint(0, 10 ** 7),
+        'acodec': 'opus',
+        'formats': [fake_format(video_id, format_index) for format_index in range(25)],
+        'thumbnails': [{'url': f'https://i.ytimg.com/vi/{video_id}/{size}.jpg', 'preference': size} for size in range(40)],
+    }
+
+
+def measure(name: str, build, tracks: int) -> float:
+    random.seed(0)
+    gc.collect()
+    tracemalloc.start()
+    items = [build(index) for index in range(tracks)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_track = size / tracks
+    print(f'{name:<20} {per_track:12,.0f} bytes/track')
+    del items
+    return per_track
+
+
+def main() -> None:
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print(f'{tracks} tracks')
+    full = measure('full info dict', fake_info, tracks)
+    measure('slim info dict', lambda index: ac.AudioCache.slim(fake_info(index)), tracks)
+    record = measure('TrackInfo', lambda index: ti.TrackInfo.from_info(fake_info(index)), tracks)
+    print(f'reduction: {full / record:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
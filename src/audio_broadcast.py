@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import logging
+import threading
+import typing as t
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+FRAME_LENGTH = 0.02
+
+# Creates the FFmpeg source of a stream, starting at the given second
+SourceFactory = t.Callable[[float], discord.FFmpegAudio]
+
+
+class Broadcaster:
+    """A single FFmpeg decoder whose frames are shared by many subscribers
+
+    The frames are kept in a ring buffer. Each subscriber has its own cursor over it.
+    The decoder is driven by the subscriber that is ahead: it only decodes a new frame when someone asks for it.
+    """
+
+    def __init__(self, key: t.Hashable, original: discord.FFmpegAudio, capacity: int) -> None:
+        self.key = key
+        self.original = original
+        self.capacity = capacity
+        self.subscribers: set[BroadcastSubscriber] = set()
+        # Absolute index of the next frame to be decoded
+        self.head = 0
+        self.ended = False
+        self._ring: list[bytes | None] = [None] * capacity
+        self._lock = threading.Lock()
+        self._decode_lock = threading.Lock()
+
+    @property
+    def tail(self) -> int:
+        """Absolute index of the oldest frame still in the ring"""
+        return max(0, self.head - self.capacity)
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def frame(self, index: int) -> bytes | None:
+        """Get the frame at an absolute index
+
+        Returns:
+            bytes | None: The frame. Empty bytes at the end of the stream. None if the frame already left the ring
+        """
+        with self._lock:
+            if index < self.tail:
+                return None
+            if index < self.head:
+                return self._ring[index % self.capacity]
+
+        with self._decode_lock:
+            # Decode until the frame is available. Other subscribers may have done it meanwhile
+            while index >= self.head and not self.ended:
+                frame = self.original.read()
+                with self._lock:
+                    if not frame:
+                        self.ended = True
+                        break
+                    self._ring[self.head % self.capacity] = frame
+                    self.head += 1
+        with self._lock:
+            if index < self.tail:
+                return None
+            if index < self.head:
+                return self._ring[index % self.capacity]
+        return b''
+
+    def cleanup(self) -> None:
+        # Not under the decode lock: a reader may hold it while blocked on FFmpeg. Killing FFmpeg unblocks it
+        self.original.cleanup()
+        with self._lock:
+            self.ended = True
+            self._ring = [None] * self.capacity
+
+
+class BroadcastSubscriber(discord.AudioSource):
+    """A cursor over a Broadcaster. Used as the "original" of an AudioSource
+
+    If the subscriber falls behind the ring (e.g. it was paused), it leaves the broadcaster and continues on a private FFmpeg source from its position.
+    """
+
+    def __init__(self, hub: BroadcastHub, broadcaster: Broadcaster, start: float, factory: SourceFactory) -> None:
+        self.hub = hub
+        self.broadcaster = broadcaster
+        self.start = start
+        self.factory = factory
+        self.cursor = 0
+        self._private: discord.FFmpegAudio | None = None
+
+    @property
+    def position(self) -> float:
+        """Seconds from the beginning of the stream"""
+        return self.start + self.cursor * FRAME_LENGTH
+
+    def read(self) -> bytes:
+        if self._private is not None:
+            self.cursor += 1
+            return self._private.read()
+
+        frame = self.broadcaster.frame(self.cursor)
+        if frame is None:
+            logger.debug(f'Subscriber fell behind the broadcast of "{self.broadcaster.key}". Continuing on a private source')
+            self._private = self.factory(self.position)
+            self.hub.unsubscribe(self)
+            return self.read()
+        self.cursor += 1
+        return frame
+
+    def is_opus(self) -> bool:
+        return self.broadcaster.is_opus()
+
+    def cleanup(self) -> None:
+        if self._private is not None:
+            self._private.cleanup()
+            self._private = None
+        self.hub.unsubscribe(self)
+
+
+class BroadcastHub:
+    """Share one decoder per (stream, start offset) between every voice client that plays it at the same time"""
+
+    def __init__(self, window: float = 10) -> None:
+        """
+        Args:
+            window (float, optional): Seconds of audio kept in each ring buffer.
+                A subscriber can join a broadcast that started at most this long ago. Defaults to 10.
+        """
+        self.capacity = max(1, int(window / FRAME_LENGTH))
+        self._broadcasters: dict[t.Hashable, Broadcaster] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key: t.Hashable, start: float, factory: SourceFactory) -> BroadcastSubscriber:
+        """Subscribe to the broadcast of a key. A new broadcaster is started if there is none that still has the first frame
+
+        Args:
+            key (t.Hashable): Identify equal streams. Must include the stream url and the start offset
+            start (float): The start offset (in seconds) of the stream
+            factory (SourceFactory): Creates the FFmpeg source of the stream
+        """
+        with self._lock:
+            broadcaster = self._broadcasters.get(key)
+            if broadcaster is None or broadcaster.ended or broadcaster.tail > 0:
+                broadcaster = Broadcaster(key, factory(start), self.capacity)
+                self._broadcasters[key] = broadcaster
+            subscriber = BroadcastSubscriber(self, broadcaster, start, factory)
+            broadcaster.subscribers.add(subscriber)
+        logger.debug(f'{len(broadcaster.subscribers)} subscribers on the broadcast of "{key}"')
+        return subscriber
+
+    def unsubscribe(self, subscriber: BroadcastSubscriber) -> None:
+        """Remove a subscriber. The decoder is torn down when its last subscriber leaves"""
+        broadcaster = subscriber.broadcaster
+        with self._lock:
+            if subscriber not in broadcaster.subscribers:
+                return
+            broadcaster.subscribers.discard(subscriber)
+            if broadcaster.subscribers:
+                return
+            if self._broadcasters.get(broadcaster.key) is broadcaster:
+                del self._broadcasters[broadcaster.key]
+        broadcaster.cleanup()
+
+    def __len__(self) -> int:
+        return len(self._broadcasters)
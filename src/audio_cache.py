@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import collections
+import enum
+import json
+import logging
+import sqlite3
+import threading
+import time
+import typing as t
+import urllib.parse
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Keys of the yt-dlp info dict that are never used after the resolution and only take space
+HEAVY_INFO_KEYS = (
+    'formats',
+    'requested_formats',
+    'thumbnails',
+    'automatic_captions',
+    'subtitles',
+    'heatmap',
+    'chapters',
+    'http_headers',
+    'fragments',
+)
+
+
+class CacheState(enum.Enum):
+    MISS = 'miss'
+    # The whole info dict, including the stream url, can be used
+    FRESH = 'fresh'
+    # The metadata is still good but the stream url expired and must be re-resolved
+    STALE = 'stale'
+
+
+class CacheLookup(t.NamedTuple):
+    state: CacheState
+    info: dict | None = None
+    # The tier the entry was found on: "memory" or "disk"
+    tier: str | None = None
+
+
+class AudioCache:
+    """Two tier (memory LRU and on-disk) cache for resolved yt-dlp info dicts
+
+    Entries are stored by their canonical ``webpage_url``. Normalized searches are stored as aliases that point to a ``webpage_url``,
+    so different searches resolving to the same track share a single entry.
+    The loudness normalization gain of each track is also stored by its ``webpage_url``. It does not expire with the info dict.
+    """
+
+    def __init__(self, path: Path | str | None,
+            max_memory_entries: int = 256,
+            info_ttl: float = 7 * 24 * 60 * 60,
+            stream_ttl: float = 60 * 60,
+            expiry_margin: float = 10 * 60,
+    ) -> None:
+        """
+        Args:
+            path (Path | str | None): The sqlite file of the on-disk tier. If None, only the memory tier is used.
+            max_memory_entries (int, optional): Maximum amount of tracks in the memory tier. Defaults to 256.
+            info_ttl (float, optional): Seconds the metadata of a track is considered valid. Defaults to 7 days.
+            stream_ttl (float, optional): Seconds a stream url is considered valid when it carries no expiry. Defaults to 1 hour.
+            expiry_margin (float, optional): Seconds before the real expiry that a stream url is already considered expired. Defaults to 10 minutes.
+        """
+        self.max_memory_entries = max_memory_entries
+        self.info_ttl = info_ttl
+        self.stream_ttl = stream_ttl
+        self.expiry_margin = expiry_margin
+
+        self._entries: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        self._aliases: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._gains: collections.OrderedDict[str, float] = collections.OrderedDict()
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+        self.path = Path(path) if path is not None else None
+        self._db: sqlite3.Connection | None = None
+        self.open()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Hit and miss counters of the cache"""
+        stats = dict.fromkeys(('hits', 'stale_hits', 'misses', 'memory_hits', 'disk_hits'), 0)
+        stats |= self._counters
+        stats['memory_entries'] = len(self._entries)
+        return stats
+
+    def get(self, search: str, disk: bool = True, count: bool = True) -> CacheLookup:
+        """Look up a search or a webpage url
+
+        Args:
+            search (str): A URL or name to search
+            disk (bool, optional): Whether to look up the on-disk tier when the memory tier misses. Defaults to True.
+            count (bool, optional): Whether to count the lookup in the stats. Lookups that may be followed by another one
+                of the same search (e.g. a tier of a resolver chain) count it with "count" only if it is the final one. Defaults to True.
+
+        Returns:
+            CacheLookup: The state of the entry, its info dict (if any) and the tier it was found on
+        """
+        key = self.normalize(search)
+        with self._lock:
+            entry, tier = self._get_entry(key, disk)
+
+        if entry is None or entry['resolved_at'] + self.info_ttl < time.time():
+            lookup = CacheLookup(CacheState.MISS)
+        else:
+            info = dict(entry['info'])
+            state = CacheState.STALE if entry['expires_at'] - self.expiry_margin < time.time() else CacheState.FRESH
+            lookup = CacheLookup(state, info, tier)
+        if count:
+            self.count(lookup)
+        return lookup
+
+    def count(self, lookup: CacheLookup) -> None:
+        """Count a lookup in the stats"""
+        if lookup.state is CacheState.MISS:
+            self._counters['misses'] += 1
+            return
+        self._counters['hits' if lookup.state is CacheState.FRESH else 'stale_hits'] += 1
+        self._counters[f'{lookup.tier}_hits'] += 1
+
+    def put(self, search: str, info: dict) -> None:
+        """Store a resolved info dict under a search and under its canonical webpage url
+
+        Args:
+            search (str): The search that resolved to the info dict
+            info (dict): The processed yt-dlp info dict
+        """
+        webpage_url = info.get('webpage_url')
+        if not webpage_url:
+            return
+        now = time.time()
+        entry = {
+            'info': self.slim(info),
+            'resolved_at': now,
+            'expires_at': self.stream_expiry(info.get('url'), now),
+        }
+        key = self.normalize(webpage_url)
+        alias = self.normalize(search)
+        with self._lock:
+            self._remember(key, entry)
+            self._remember_alias(alias, key)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)',
+                        (key, json.dumps(entry['info'], default=str), entry['resolved_at'], entry['expires_at'])
+                    )
+                    if alias != key:
+                        self._db.execute('INSERT OR REPLACE INTO aliases VALUES (?, ?)', (alias, key))
+                    self._db.commit()
+                except sqlite3.Error as error:
+                    logger.warning(f'Failed to persist the cache entry of "{webpage_url}": {error}')
+
+    def get_gain(self, webpage_url: str) -> float | None:
+        """Get the stored loudness normalization gain of a track. None if it was not measured yet"""
+        key = self.normalize(webpage_url)
+        with self._lock:
+            if (gain := self._gains.get(key)) is not None:
+                self._gains.move_to_end(key)
+                return gain
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute('SELECT gain FROM gains WHERE url = ?', (key,)).fetchone()
+            except sqlite3.Error as error:
+                logger.warning(f'Failed to read the gain of "{key}": {error}')
+                return None
+            if row is None:
+                return None
+            self._remember_gain(key, row[0])
+            return row[0]
+
+    def put_gain(self, webpage_url: str, gain: float) -> None:
+        """Store the loudness normalization gain of a track"""
+        key = self.normalize(webpage_url)
+        with self._lock:
+            self._remember_gain(key, gain)
+            if self._db is not None:
+                try:
+                    self._db.execute('INSERT OR REPLACE INTO gains VALUES (?, ?)', (key, gain))
+                    self._db.commit()
+                except sqlite3.Error as error:
+                    logger.warning(f'Failed to persist the gain of "{webpage_url}": {error}')
+
+    def clear(self) -> None:
+        """Remove every entry of both tiers"""
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+            self._gains.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM tracks')
+                self._db.execute('DELETE FROM aliases')
+                self._db.execute('DELETE FROM gains')
+                self._db.commit()
+
+    def open(self) -> None:
+        """Open the on-disk tier, if there is one and it is closed"""
+        with self._lock:
+            if self._db is None and self.path is not None:
+                self._db = self._open_db(self.path)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stream_expiry(self, stream_url: str | None, now: float | None = None) -> float:
+        """Get the timestamp when a stream url expires
+
+        Uses the "expire" query parameter that signed stream urls (e.g. googlevideo) carry. Falls back to the stream ttl.
+        """
+        now = time.time() if now is None else now
+        if not stream_url:
+            return now
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(stream_url).query)
+        if expire := query.get('expire'):
+            try:
+                return float(expire[0])
+            except ValueError:
+                pass
+        return now + self.stream_ttl
+
+    @staticmethod
+    def normalize(search: str) -> str:
+        search = search.strip()
+        # URLs are case sensitive (e.g. YouTube video IDs). Only collapse whitespaces and case of plain searches
+        if urllib.parse.urlsplit(search).scheme in ('http', 'https'):
+            return search
+        return ' '.join(search.lower().split())
+
+    @staticmethod
+    def slim(info: dict) -> dict:
+        slim = {key: value for key, value in info.items() if key not in HEAVY_INFO_KEYS}
+        if info.get('formats') and 'audio_formats' not in slim:
+            # Only what is needed to pick a format by bitrate later (see audio_resolver.select_audio_format)
+            slim['audio_formats'] = [
+                [fmt.get('format_id'), fmt.get('acodec'), fmt.get('abr'), fmt['url']]
+                for fmt in info['formats']
+                if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none') and fmt.get('url')
+            ]
+        return slim
+
+    def _get_entry(self, key: str, disk: bool = True) -> tuple[dict | None, str | None]:
+        key = self._aliases.get(key, key)
+        if (entry := self._entries.get(key)) is not None:
+            self._entries.move_to_end(key)
+            return entry, 'memory'
+        if self._db is None or not disk:
+            return None, None
+
+        try:
+            alias_row = self._db.execute('SELECT url FROM aliases WHERE search = ?', (key,)).fetchone()
+            url = alias_row[0] if alias_row else key
+            row = self._db.execute('SELECT info, resolved_at, expires_at FROM tracks WHERE url = ?', (url,)).fetchone()
+        except sqlite3.Error as error:
+            logger.warning(f'Failed to read the cache entry of "{key}": {error}')
+            return None, None
+        if row is None:
+            return None, None
+
+        info, resolved_at, expires_at = row
+        entry = {'info': json.loads(info), 'resolved_at': resolved_at, 'expires_at': expires_at}
+        # Promote to the memory tier
+        self._remember(url, entry)
+        self._remember_alias(key, url)
+        return entry, 'disk'
+
+    def _remember(self, key: str, entry: dict) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_memory_entries:
+            self._entries.popitem(last=False)
+
+    def _remember_alias(self, alias: str, key: str) -> None:
+        if alias == key:
+            return
+        self._aliases[alias] = key
+        self._aliases.move_to_end(alias)
+        # Aliases are tiny. Keep a few of them per track
+        while len(self._aliases) > self.max_memory_entries * 4:
+            self._aliases.popitem(last=False)
+
+    def _remember_gain(self, key: str, gain: float) -> None:
+        self._gains[key] = gain
+        self._gains.move_to_end(key)
+        # A float per track. Keep many more than info dicts
+        while len(self._gains) > self.max_memory_entries * 16:
+            self._gains.popitem(last=False)
+
+    @staticmethod
+    def _open_db(path: Path) -> sqlite3.Connection:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS tracks (url TEXT PRIMARY KEY, info TEXT NOT NULL, resolved_at REAL NOT NULL, expires_at REAL NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS aliases (search TEXT PRIMARY KEY, url TEXT NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS gains (url TEXT PRIMARY KEY, gain REAL NOT NULL)')
+        db.commit()
+        return db
@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import sys
+import typing as t
+
+from async_timeout import timeout
+
+import audio_cache as ac
+import custom_errors as ce
+import ytdl_worker
+
+logger = logging.getLogger(__name__)
+
+# Kbps. Voice channel bitrates are grouped in these tiers to pick and cache the audio format
+BITRATE_TIERS = (64, 96, 128, 160)
+
+
+class AudioFormat(t.NamedTuple):
+    format_id: str
+    acodec: str
+    abr: float | None
+    url: str
+
+
+def bitrate_tier(bitrate: int) -> int:
+    """The smallest tier (kbps) at or above a voice channel bitrate (bps)"""
+    kbps = bitrate / 1000
+    return next((tier for tier in BITRATE_TIERS if tier >= kbps), BITRATE_TIERS[-1])
+
+
+def select_audio_format(formats: t.Iterable[AudioFormat], tier: int) -> AudioFormat | None:
+    """Pick the audio format to send at a bitrate tier
+
+    Opus formats are preferred, as Discord sends Opus. Among them, the one at or just above the tier,
+    or the best one if none reaches it. There is no point in fetching and decoding more than the channel can carry.
+    """
+    formats = list(formats)
+    opus = [fmt for fmt in formats if fmt.acodec.startswith('opus')]
+    candidates = [fmt for fmt in opus or formats if fmt.abr]
+    if not candidates:
+        return None
+    enough = [fmt for fmt in candidates if fmt.abr >= tier]
+    if enough:
+        return min(enough, key=lambda fmt: fmt.abr)
+    return max(candidates, key=lambda fmt: fmt.abr)
+
+
+class ThreadExtractor:
+    """Run yt-dlp extractions on the default thread executor of the event loop"""
+
+    def __init__(self, ytdl_options: dict) -> None:
+        self.ytdl_options = ytdl_options
+
+    async def extract_info(self, search: str, process: bool = True, ytdl_options: dict | None = None) -> dict | None:
+        """Extract the slim info dict of a search
+
+        Args:
+            search (str): A URL or name to search
+            process (bool, optional): Whether to fully process the results. Defaults to True.
+            ytdl_options (dict | None, optional): Options to use instead of the extractor ones. Defaults to None.
+
+        Raises:
+            ce.YTDLError: When there is an error with YoutubeDL while trying to get the info.
+        """
+        partial = functools.partial(ytdl_worker.extract_info, search, ytdl_options or self.ytdl_options, process)
+        info, error = await asyncio.get_running_loop().run_in_executor(None, partial)
+        if error is not None:
+            raise ce.YTDLError(f'Couldn\'t fetch "{search}": {error}')
+        return info
+
+    async def warm(self) -> None:
+        return
+
+    def close(self) -> None:
+        return
+
+
+class ProcessExtractor(ThreadExtractor):
+    """Run yt-dlp extractions on a pool of pre-warmed worker processes
+
+    yt-dlp extraction is CPU bound Python. Running it on other processes keeps it from fighting the gateway and the voice threads for the GIL.
+    An extraction that times out keeps its worker busy, so the pool is replaced by a fresh one and the workers of the old one are killed
+    once its other jobs had the time to finish.
+    """
+
+    def __init__(self, ytdl_options: dict, workers: int = 2, timeout: float = 30, max_jobs_per_worker: int = 50) -> None:
+        """
+        Args:
+            ytdl_options (dict): Options to pass to YoutubeDL
+            workers (int, optional): The amount of worker processes. Defaults to 2.
+            timeout (float, optional): Maximum seconds for a single extraction. Defaults to 30.
+            max_jobs_per_worker (int, optional): Jobs after which a worker is replaced by a fresh one. Defaults to 50.
+        """
+        super().__init__(ytdl_options)
+        self.workers = workers
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+        # Jobs submitted to the current pool. Used to recycle it where the workers can not be recycled one by one
+        self._jobs = 0
+
+    async def extract_info(self, search: str, process: bool = True, ytdl_options: dict | None = None) -> dict | None:
+        partial = functools.partial(ytdl_worker.extract_info, search, ytdl_options or self.ytdl_options, process)
+        pool = self._get_pool()
+        self._jobs += 1
+        try:
+            async with timeout(self.timeout):
+                info, error = await asyncio.get_running_loop().run_in_executor(pool, partial)
+        except asyncio.TimeoutError as e:
+            # The extraction is still running on its worker. Stop sending jobs to that pool
+            logger.warning(f'Extraction of "{search}" timed out. Replacing the process pool')
+            self._retire(pool, kill=True)
+            raise ce.YTDLError(f'Timed out while fetching "{search}"') from e
+        except concurrent.futures.BrokenExecutor as e:
+            # A worker died abruptly. Start a new pool for the next extractions
+            logger.error('The extraction process pool broke. Restarting it')
+            self.close()
+            raise ce.YTDLError(f'Couldn\'t fetch "{search}"') from e
+        if error is not None:
+            raise ce.YTDLError(f'Couldn\'t fetch "{search}": {error}')
+        return info
+
+    async def warm(self) -> None:
+        """Start every worker process, so the first extractions do not pay for the process start and the yt-dlp imports"""
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        # Each submission spawns a new worker while there is no idle one
+        await asyncio.gather(*(loop.run_in_executor(pool, ytdl_worker.ping) for _ in range(self.workers)))
+        logger.info(f'Extraction process pool warmed with {self.workers} workers')
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _retire(self, pool: concurrent.futures.ProcessPoolExecutor, kill: bool = False) -> None:
+        """Send the next jobs to a new pool. The jobs already submitted to the old one still run on it
+
+        Args:
+            pool (concurrent.futures.ProcessPoolExecutor): The pool to retire.
+            kill (bool, optional): Whether to kill its workers after the timeout, for the ones stuck on a job. Defaults to False.
+        """
+        if self._pool is pool:
+            self._pool = None
+            self._jobs = 0
+        # The executor has no public way to stop its workers, and forgets them on shutdown
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        pool.shutdown(wait=False)
+        if kill:
+            # Every other job of the pool finishes or times out before then
+            asyncio.get_running_loop().call_later(self.timeout, self._kill_workers, processes)
+
+    @staticmethod
+    def _kill_workers(processes: list[multiprocessing.Process]) -> None:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._pool is not None and self._jobs >= self.workers * self.max_jobs_per_worker and sys.version_info < (3, 11):
+            # Without "max_tasks_per_child", the whole pool is recycled after the same amount of jobs
+            self._retire(self._pool)
+        if self._pool is None:
+            # Recycling workers after some jobs is only supported on python 3.11+
+            recycling = {'max_tasks_per_child': self.max_jobs_per_worker} if sys.version_info >= (3, 11) else {}
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                # "spawn" is required to recycle workers and does not copy the bot state into the workers
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=ytdl_worker.init_worker,
+                initargs=(self.ytdl_options,),
+                **recycling,
+            )
+        return self._pool
+
+
+class YTDLResolver:
+    """Resolve searches and URLs into playable yt-dlp info dicts
+
+    - Gets to a playable info dict with a single (processed) extraction whenever possible
+    - Reuses long-lived YoutubeDL objects (one per executor thread or worker process, as they are not thread safe)
+    - Coalesces concurrent identical lookups into a single in-flight future
+    - Serves and fills the given AudioCache
+    - Picks the audio format by the bitrate of the voice channel, caching the choice per track and bitrate tier
+    """
+
+    def __init__(self, extractor: ThreadExtractor, cache: ac.AudioCache | None = None, max_format_choices: int = 4096) -> None:
+        self.extractor = extractor
+        self.cache = cache
+        self.max_format_choices = max_format_choices
+        self._in_flight: dict[str, asyncio.Future[dict]] = {}
+        self._format_choices: collections.OrderedDict[tuple[str, int], str] = collections.OrderedDict()
+
+    async def resolve(self, search: str, bitrate: int | None = None) -> dict:
+        """Get the processed info dict of a search
+
+        Args:
+            search (str): A URL or name to search
+            bitrate (int | None, optional): The bitrate (bps) of the voice channel the audio is sent to.
+                If given, the stream of the info dict is the format that best fits it. Defaults to None.
+
+        Raises:
+            ce.YTDLError: When there is an error with YoutubeDL while trying to get the audio.
+
+        Returns:
+            dict: The processed yt-dlp info dict. Must not be mutated, as it may be shared between callers
+        """
+        key = ac.AudioCache.normalize(search)
+        if (future := self._in_flight.get(key)) is None:
+            future = asyncio.ensure_future(self._resolve(search))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shield the shared future, so one cancelled caller does not cancel the lookup of the others
+        info = await asyncio.shield(future)
+        if bitrate is None:
+            return info
+        return self.with_format(info, bitrate_tier(bitrate))
+
+    def with_format(self, info: dict, tier: int) -> dict:
+        """A copy of an info dict whose stream is the audio format picked for a bitrate tier"""
+        formats = [AudioFormat(*fmt) for fmt in info.get('audio_formats') or ()]
+        if not formats:
+            return info
+        key = (info.get('webpage_url'), tier)
+        format_id = self._format_choices.get(key)
+        chosen = next((fmt for fmt in formats if fmt.format_id == format_id), None)
+        if chosen is None:
+            chosen = select_audio_format(formats, tier)
+            if chosen is None:
+                return info
+            self._format_choices[key] = chosen.format_id
+            while len(self._format_choices) > self.max_format_choices:
+                self._format_choices.popitem(last=False)
+        self._format_choices.move_to_end(key)
+        return info | {'url': chosen.url, 'acodec': chosen.acodec, 'abr': chosen.abr, 'format_id': chosen.format_id}
+
+    async def resolve_playlist(self, url: str) -> tuple[str, list[dict]]:
+        """Get the title and the entries of a playlist with a single flat extraction
+
+        The entries are not processed. Each one must be resolved later with "resolve" (using its "url").
+
+        Raises:
+            ce.YTDLError: When there is an error with YoutubeDL while trying to get the playlist.
+
+        Returns:
+            tuple[str, list[dict]]: The playlist title and its flat entries
+        """
+        ytdl_options = self.extractor.ytdl_options | {'noplaylist': False, 'extract_flat': 'in_playlist'}
+        data = await self.extractor.extract_info(url, ytdl_options=ytdl_options)
+        if data is None:
+            raise ce.YTDLError(f'Couldn\'t find anything that matches "{url}"')
+        if 'entries' not in data:
+            # Not a playlist. Treat it as a playlist of a single track
+            return data.get('title', url), [data]
+        entries = [entry for entry in data['entries'] if entry and (entry.get('url') or entry.get('webpage_url'))]
+        return data.get('title', url), entries
+
+    async def _resolve(self, search: str) -> dict:
+        if self.cache is None:
+            return await self._extract(search)
+
+        # The on-disk tier is not read on the event loop
+        lookup = await asyncio.get_running_loop().run_in_executor(None, self.cache.get, search)
+        if lookup.state is ac.CacheState.FRESH:
+            return lookup.info
+        if lookup.state is ac.CacheState.STALE:
+            # The metadata is still good. Only the stream url must be re-resolved, so the search step can be skipped
+            info = await self._extract(lookup.info['webpage_url'])
+        else:
+            info = await self._extract(search)
+        self.cache.put(search, info)
+        return info
+
+    async def _extract(self, search: str) -> dict:
+        data = await self.extractor.extract_info(search)
+        if data is None:
+            raise ce.YTDLError(f'Couldn\'t find anything that matches "{search}"')
+
+        info = data
+        if 'entries' in data:
+            info = next((entry for entry in data['entries'] if entry), None)
+            if info is None:
+                raise ce.YTDLError(f"Couldn\'t find anything that matches `{search}`")
+
+        # Some extractors only return a reference to the track (e.g. "url_transparent" results).
+        # Only in this case a second extraction is needed to get to a playable info dict
+        if 'url' not in info or info.get('_type') in ('url', 'url_transparent'):
+            webpage_url = info.get('webpage_url') or info['url']
+            logger.debug(f'Single pass extraction of "{search}" was not playable. Processing "{webpage_url}"')
+            info = await self.extractor.extract_info(webpage_url)
+            if info is None or 'url' not in info:
+                raise ce.YTDLError(f"Couldn\'t fetch `{webpage_url}`")
+        return info
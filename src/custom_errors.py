@@ -18,5 +18,9 @@ class UnhandledError(commands.CommandError):
     pass
 
 
+class QueuePositionError(commands.CommandError):
+    pass
+
+
 class NoVoiceChannelError(commands.CheckFailure):
     pass
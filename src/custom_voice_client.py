@@ -1,31 +1,50 @@
 from __future__ import annotations
 
 import asyncio
-import collections
 import contextlib
 import functools
-import random
+import itertools
+import logging
+import sys
+import time
 import typing as t
-from asyncio import QueueFull
 from pathlib import Path
 
 import discord
-# import youtube_dl
-import yt_dlp as youtube_dl
 from async_timeout import timeout
 from discord.ext import commands
 
+import audio_broadcast as ab
+import audio_cache as ac
+import audio_resolver as ar
 import custom_context as cc
 import custom_errors as ce
+import indexed_list as il
+import local_library as ll
+import loudness as ln
+import now_playing as nplay
+import pcm_processor as pcm
+import read_ahead as ra
+import resolver_chain as rc
+import track_index as tx
+import track_info as ti
+from settings import settings
+
+logger = logging.getLogger(__name__)
 
 THIS_FOLDER = Path(__file__).parent
 FFMPEG_PATH = THIS_FOLDER/'ffmpeg.exe'
+CACHE_FOLDER = THIS_FOLDER/'.cache'
 
 FFMPEG_OPTIONS = {
     # 'executable': str(FFMPEG_PATH),
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn',
 }
+# For the files of the local library. The reconnect options only apply to network streams
+LOCAL_FFMPEG_OPTIONS = {
+    'options': '-vn',
+}
 
 YTDL_OPTIONS = {
     'audioformat': 'mp3',
@@ -38,26 +57,107 @@ YTDL_OPTIONS = {
     'default_search': 'ytsearch',
 }
 
+AUDIO_CACHE = ac.AudioCache(
+    CACHE_FOLDER/'audio_cache.sqlite3' if settings.music.cache_persist else None,
+    max_memory_entries=settings.music.cache_memory_entries,
+    info_ttl=settings.music.cache_info_ttl,
+)
+if settings.music.extraction_backend == 'process':
+    _extractor = ar.ProcessExtractor(
+        YTDL_OPTIONS,
+        workers=settings.music.extraction_workers,
+        timeout=settings.music.extraction_timeout,
+        max_jobs_per_worker=settings.music.extraction_worker_max_jobs,
+    )
+else:
+    _extractor = ar.ThreadExtractor(YTDL_OPTIONS)
+RESOLVER = ar.YTDLResolver(_extractor, AUDIO_CACHE)
+
+# Measures each track once. Its gain is stored in the audio cache
+LOUDNESS = ln.LoudnessAnalyzer(
+    target=settings.music.loudness_target,
+    max_concurrency=settings.music.loudness_concurrency,
+    max_seconds=settings.music.loudness_max_seconds,
+    before_options=FFMPEG_OPTIONS['before_options'],
+) if settings.music.loudness_normalization else None
+
+# Tracks already resolved, for the autocomplete of searches
+TRACK_INDEX = tx.TrackIndex(
+    CACHE_FOLDER/'track_index.json.gz' if settings.music.cache_persist else None,
+    max_tracks=settings.music.track_index_size,
+)
+
+# Local audio files, played without yt-dlp. None when no library folder is configured
+LIBRARY = ll.LocalLibrary(
+    settings.music.library_path,
+    CACHE_FOLDER/'local_library.json.gz' if settings.music.cache_persist else None,
+) if settings.music.library_path else None
+# Seconds between two scans of the local library
+LIBRARY_SCAN_INTERVAL = settings.music.library_scan_interval
+
+# Resolves the play searches: memory cache, on-disk cache, local library and yt-dlp, hedged (see HedgedResolver)
+TRACK_RESOLVER = rc.HedgedResolver([
+    rc.MemoryCacheTier(RESOLVER),
+    *([rc.DiskCacheTier(RESOLVER, budget=settings.music.cache_hedge_delay)] if settings.music.cache_persist else []),
+    *([rc.LibraryTier(LIBRARY)] if LIBRARY is not None else []),
+    rc.YTDLTier(RESOLVER),
+])
+
+# "opus" or "pcm"
+PLAYBACK_MODE = settings.music.playback_mode
+# Opus streams are only copied through (without decoding and encoding them again) at full volume, so the "opus" mode starts at full volume
+DEFAULT_VOLUME = settings.music.default_volume if settings.music.default_volume is not None else (1.0 if PLAYBACK_MODE == 'opus' else 0.5)
+
+BROADCAST_HUB = ab.BroadcastHub(settings.music.broadcast_window) if settings.music.broadcast else None
+# Seconds of audio read ahead of the voice send loop. 0 to read straight from FFmpeg
+READ_AHEAD = settings.music.read_ahead
+# Seconds before the end of a track when the source of the next one is started
+PREROLL = settings.music.preroll
+# Seconds of crossfade between PCM tracks. 0 to disable
+CROSSFADE = settings.music.crossfade
+# A stream that ends more than these seconds before the duration of its track was interrupted, and is restarted from its position
+MIN_INTERRUPTED_REMAINING = 3
+# Maximum restarts of the stream of a track
+MAX_RESTARTS = 3
+# Seconds a suspended player (nobody listening) waits for somebody before disconnecting. 0 to wait forever
+EMPTY_CHANNEL_TIMEOUT = settings.music.empty_channel_timeout
+
 
 class CustomVoiceClient(discord.VoiceClient):
     def __init__(self, client, channel,
             timeout: int = 180,
-            on_play_callback: t.Callable[[], t.Awaitable[t.Any]] = None,
+            on_play_callback: nplay.NotifyCallback = None,
     ) -> None:
         super().__init__(client, channel)
 
         if on_play_callback is None:
             on_play_callback = self._default_on_play_callback
         self.on_play_callback = on_play_callback
-
-        # TODO: attention to queue maxsize
-        self.queue = AudioQueue(20)
-        self.looping = False
+        # Runs the callback in the background, so the player never waits for Discord
+        self.now_playing = nplay.NowPlayingDispatcher(on_play_callback, settings.music.now_playing_interval)
+
+        self.queue = AudioQueue(
+            max_memory=settings.music.queue_max_memory,
+            lookahead=settings.music.lookahead,
+            resolve_concurrency=settings.music.resolve_concurrency,
+        )
+        self._looping = False
         self.timeout = timeout
         
         self._next = asyncio.Event()
+        self._current_entry: QueueEntry = None
         self._current_audio: AudioSource = None
-        self._volume = 0.5
+        self._volume = DEFAULT_VOLUME
+        self.queue.volume = self._volume
+        # The audio format of the entries is picked by the bitrate of the channel
+        self.queue.bitrate = channel.bitrate
+        # Paused because nobody was listening (see "suspend")
+        self.auto_paused = False
+        # Cleared while nobody is listening. The player does not start new tracks meanwhile
+        self._awake = asyncio.Event()
+        self._awake.set()
+        self._empty_timeout_task: asyncio.Task | None = None
+        self._preroll_task: asyncio.Task | None = None
 
         self.audio_player_task = self.client.loop.create_task(self.audio_player())
         
@@ -65,6 +165,37 @@ class CustomVoiceClient(discord.VoiceClient):
     def current_audio(self):
         return self._current_audio
         
+    @property
+    def suspended(self) -> bool:
+        """Whether the player is suspended because nobody is listening (see "suspend")"""
+        return not self._awake.is_set()
+
+    @property
+    def looping(self) -> bool:
+        return self._looping
+
+    @looping.setter
+    def looping(self, value: bool) -> None:
+        if value == self._looping:
+            return
+        self._looping = value
+        # Only a preroll that already ran for the current track prepared something for the other mode
+        if self._preroll_task is None or not self._preroll_task.done() or self._preroll_task.cancelled():
+            return
+        # Its source may have been mixed into the current track already
+        if self._current_audio is not None:
+            self._current_audio.cancel_crossfade()
+        if value:
+            if self.queue.preroll and (head := self.queue.peek()) is not None:
+                head.discard_source()
+            self.queue.preroll = False
+            self.queue.prefetch()
+        elif self._current_entry is not None:
+            # The source prepared to repeat the current entry
+            self._current_entry.discard_source()
+        # Prepare what comes next on the new mode
+        self._preroll_task = self.client.loop.create_task(self.preroll(self._current_audio))
+
     @property
     def volume(self):
         return self._volume
@@ -74,121 +205,433 @@ class CustomVoiceClient(discord.VoiceClient):
         if 0 > value > 1:
             raise ValueError('Volume must be between 0 and')
         self._volume = value
-        # Apply the new volume to the current audio
+        # Apply the new volume to the current audio. Opus sources only apply it at the next track
         self._current_audio.volume = self._volume
+        # Prepared Opus sources have the old volume baked in
+        self.queue.volume = self._volume
 
     async def audio_player(self) -> None:
         while True:
             self._next.clear()
             if not self.looping:
+                # A source prepared to loop the previous entry is not needed anymore
+                if self._current_entry is not None:
+                    self._current_entry.discard_source()
                 # Try to get the next song within 3 minutes.
                 # If no song is added to the queue in time, the player will disconnect due to performance reasons.
                 try:
                     async with timeout(self.timeout):
-                        self._current_audio = await self.queue.get()
+                        self._current_entry = await self.queue.get()
                 except asyncio.TimeoutError:
                     self.client.loop.create_task(self.disconnect())
                     return
+                # Keep the sources of the next entries ready
+                self.queue.preroll = False
+                self.queue.prefetch()
+
+            # The channel may have emptied between two tracks. Wait for somebody before starting the next one
+            await self._awake.wait()
+            try:
+                # Waits for the entry to be resolved if it is not yet.
+                # Uses the source prepared during the preroll of the previous track, so the switch is immediate
+                self._current_audio = await self._current_entry.create_source(self.volume)
+            except Exception as error:
+                # The queue already warned the requester about resolution failures
+                if not isinstance(error, ce.YTDLError):
+                    logger.exception(f'Failed to create the audio source of "{self._current_entry.search}"')
+                # Do not keep looping on a track that can not be played
+                self.looping = False
+                continue
 
             self._current_audio.volume = self.volume
+            self._current_audio.on_interrupted = self._on_interrupted
             self.play(self._current_audio, after=self.play_next)
-            await self.on_play_callback()
+            self._preroll_task = self.client.loop.create_task(self.preroll(self._current_audio))
+            self.now_playing.notify()
             await self._next.wait()
+            self._preroll_task.cancel()
+            self._preroll_task = None
+
+    async def preroll(self, audio: AudioSource) -> None:
+        """Start the source of the next track (FFmpeg and its read-ahead buffer) some seconds before the current one ends"""
+        # The end of a track of unknown duration (e.g. a live stream) can not be anticipated
+        if PREROLL <= 0 or audio.track.duration <= 0:
+            return
+        while audio.remaining > PREROLL:
+            # Check again later, as the audio may be paused meanwhile
+            await asyncio.sleep(min(audio.remaining - PREROLL, 5))
+
+        if self.looping:
+            self._current_entry.prepare_source(self.volume)
+            next_entry = self._current_entry
+        else:
+            # The queue also prepares the next entry if it is resolved later
+            self.queue.preroll = True
+            self.queue.prefetch()
+            next_entry = self.queue.peek()
+        if CROSSFADE and next_entry is not None and next_entry.source is not None:
+            audio.crossfade_into(next_entry.source, CROSSFADE)
+
+    async def on_voice_state_update(self, data) -> None:
+        await super().on_voice_state_update(data)
+        # The client may have been moved to a channel with another bitrate
+        self.queue.bitrate = getattr(self.channel, 'bitrate', None)
+
+    def suspend(self) -> None:
+        """Pause and release FFmpeg and network resources while nobody is listening. The position is kept to resume from it
+
+        If nobody comes back within the empty channel timeout, the client disconnects.
+        """
+        self._awake.clear()
+        if self.is_playing():
+            self.pause()
+            self.auto_paused = True
+        if self._current_audio is not None and self.is_paused():
+            self._current_audio.suspend()
+            logger.info(f'Suspended the player of guild {self.guild.id} at {self._current_audio.position:.1f}s. Nobody is listening')
+        if self._current_entry is not None:
+            # A source prepared to loop the current entry
+            self._current_entry.discard_source()
+        self.queue.suspend()
+        if EMPTY_CHANNEL_TIMEOUT and self._empty_timeout_task is None:
+            self._empty_timeout_task = self.client.loop.create_task(self._disconnect_when_empty())
+
+    async def wake(self) -> None:
+        """Undo a "suspend" after somebody came back. Only resumes the playback if it was paused by "suspend" """
+        if self._empty_timeout_task is not None:
+            self._empty_timeout_task.cancel()
+            self._empty_timeout_task = None
+        self._awake.set()
+        if self.auto_paused:
+            await self.resume_playback()
+        self.queue.resume()
+
+    async def resume_playback(self) -> None:
+        """Resume the playback. A suspended source is restarted, with a fresh stream url if the old one expired meanwhile"""
+        audio = self._current_audio
+        if audio is not None and audio.suspended:
+            await self._restart(audio)
+        self.resume()
+
+    def resume(self) -> None:
+        if self._current_audio is not None and self._current_audio.suspended:
+            self._current_audio.restart()
+        self.auto_paused = False
+        self.queue.resume()
+        super().resume()
+
+    async def seek(self, position: float) -> float:
+        """Restart the current audio at a position, with fast input seeking on its stream
+
+        The already resolved stream url is used. The track is only re-resolved (from the cached metadata) if the url expired.
+
+        Args:
+            position (float): Seconds from the beginning of the track
+
+        Returns:
+            float: The position the audio restarted at (clamped to the duration of the track)
+        """
+        audio = self._current_audio
+        was_playing = self.is_playing()
+        # Paused, the player does not read while the FFmpeg process is replaced
+        self.pause()
+        audio.suspend()
+        await self._restart(audio, position)
+        if was_playing:
+            self.resume()
+        return audio.position
+
+    def _on_interrupted(self) -> None:
+        # Called from the audio player thread
+        audio = self._current_audio
+        self.client.loop.call_soon_threadsafe(lambda: self.client.loop.create_task(self._recover(audio)))
+
+    async def _recover(self, audio: AudioSource) -> None:
+        # While nobody is listening the audio stays suspended. "wake" restarts it
+        if audio is not self._current_audio or self.suspended:
+            return
+        audio.restarts += 1
+        await self._refresh(audio)
+        if audio is self._current_audio and not self.suspended:
+            audio.restart()
+
+    async def _restart(self, audio: AudioSource, position: float | None = None) -> None:
+        """Restart a suspended audio (at a position) with a fresh stream url if the old one expired"""
+        await self._refresh(audio)
+        if audio is self._current_audio:
+            audio.restart(position)
+
+    async def _refresh(self, audio: AudioSource) -> None:
+        try:
+            await self._current_entry.refresh()
+        except ce.YTDLError as error:
+            # Try with the old stream url anyway
+            logger.info(f'Failed to refresh the stream of "{audio.title}": {error}')
+
+    async def _disconnect_when_empty(self) -> None:
+        await asyncio.sleep(EMPTY_CHANNEL_TIMEOUT)
+        logger.info(f'Disconnecting from guild {self.guild.id}. Nobody listened for {EMPTY_CHANNEL_TIMEOUT}s')
+        self._empty_timeout_task = None
+        self.queue.clear()
+        await self.disconnect()
+        # It may be waiting for somebody to start the next track
+        self.audio_player_task.cancel()
 
     def play_next(self, error=None) -> None:
+        # Called from the audio player thread
+        self.client.loop.call_soon_threadsafe(self._next.set)
         if error:
             raise ce.VoiceError(str(error))
-        self._next.set()
         
-    async def _default_on_play_callback(self) -> None:
-        return
+    async def _default_on_play_callback(self, previous: discord.Message | None) -> discord.Message | None:
+        return previous
 
     def __del__(self) -> None:
         self.audio_player_task.cancel()
+        self.now_playing.close()
+        if self._empty_timeout_task is not None:
+            self._empty_timeout_task.cancel()
 
 
-class AudioSource(discord.PCMVolumeTransformer):
-    def __init__(self, original: discord.FFmpegPCMAudio, volume: float, *, source_data: dict = None) -> None:
-        super().__init__(original, volume)
+class AudioSource(discord.AudioSource):
+    """An audio with its metadata
+
+    Wraps either a PCM source, whose volume is applied by a PCMFrameProcessor,
+    or an Opus source, whose volume is applied by FFmpeg (see "baked_volume") and only changes at the next track.
+    """
+
+    def __init__(self, original: discord.FFmpegAudio | ab.BroadcastSubscriber | ra.ReadAheadBuffer, volume: float, *,
+            track: ti.TrackInfo,
+            requester: discord.Member,
+            channel: discord.abc.Messageable,
+            baked_volume: float | None = None,
+            factory: ab.SourceFactory | None = None,
+    ) -> None:
+        self.original = original
         # Metadata about the audio
-        # TODO: review this data and keep only the necessary
-        self.requester = source_data.get('requester')
-        self.channel = source_data.get('channel')
-        self.data = source_data
-        self.uploader = source_data.get('uploader')
-        self.uploader_url = source_data.get('uploader_url')
-        date = source_data.get('upload_date')
-        self.upload_date = f'{date[6:8]}.{date[4:6]}.{date[:4]}'
-        self.title = source_data.get('title')
-        self.thumbnail = source_data.get('thumbnail')
-        self.description = source_data.get('description')
-        self.duration = self.parse_duration(int(source_data.get('duration')))
-        self.tags = source_data.get('tags')
-        self.url = source_data.get('webpage_url')
-        self.views = source_data.get('view_count')
-        self.likes = source_data.get('like_count')
-        self.dislikes = source_data.get('dislike_count')
-        self.stream_url = source_data.get('url')
+        self.track = track
+        self.requester = requester
+        self.channel = channel
+        # The volume FFmpeg applies on Opus sources. None for PCM sources
+        self.baked_volume = baked_volume
+        # Starts a new FFmpeg source of the track at a given second. Used to restart a suspended source
+        self.factory = factory
+        # Whether the FFmpeg source was stopped to save resources (see "suspend")
+        self.suspended = False
+        # Called from the audio player thread when the stream breaks before its end. The FFmpeg source is already suspended
+        self.on_interrupted: t.Callable[[], t.Any] | None = None
+        self.restarts = 0
+        self.closed = False
+        # Frames of the stream sent so far. The silence sent while the read ahead buffer is empty does not count
+        self.frames = 0
+        # Silence frames sent while the read ahead buffer was empty, on every FFmpeg source of the track
+        self.silent_frames = 0
+        self._volume = max(volume, 0.0)
+        self._processor = self._create_processor(original, 0)
+        self._crossfade_source: AudioSource | None = None
+        self._crossfade_frames = 0
+
+    def _create_processor(self, original: discord.AudioSource, start: float) -> pcm.PCMFrameProcessor | None:
+        if original.is_opus():
+            return None
+        remaining = self.track.duration - start
+        return pcm.PCMFrameProcessor(
+            original,
+            min(self._volume * self.track.gain, 2.0),
+            ramp=settings.music.volume_ramp,
+            fade_in=settings.music.fade_in,
+            fade_out=settings.music.fade_out,
+            total_frames=int(remaining / pcm.FRAME_LENGTH) if remaining > 0 else None,
+        )
 
-    @classmethod
-    async def create_source(cls, ctx: cc.CustomContext, search: str, ytdl_options: dict = YTDL_OPTIONS, ffmpeg_options: dict = FFMPEG_OPTIONS, volume: float = 0.5) -> AudioSource:
-        """Creates a AudioSource
+    @property
+    def volume(self) -> float:
+        return self._volume
 
-        Uses YoutubeDL to get the url of a song and pass it to the FFmpegPCMAudio to build an AudioSource (AudioSource is subclass of PCMVolumeTransformer)
+    @volume.setter
+    def volume(self, value: float) -> None:
+        self._volume = max(value, 0.0)
+        if self._processor is not None:
+            # Ramped smoothly by the processor
+            self._processor.volume = min(self._volume * self.track.gain, 2.0)
 
-        Args:
-            ctx (cc.CustomContext): The command context
-            search (str): A URL or name to search
-            ytdl_options (dict, optional): Options to pass to YoutubeDL. Defaults to YTDL_OPTIONS.
-            ffmpeg_options (dict, optional): Options to pass to FFMPEG. Defaults to FFMPEG_OPTIONS.
-            volume (float, optional): The initial volume of the AudioSource. Defaults to 0.5.
+    @property
+    def title(self) -> str:
+        return self.track.title
 
-        Raises:
-            ce.YTDLError: When there is an error with YoutubeDL while trying to get the audio.
+    @property
+    def duration(self) -> str:
+        return self.parse_duration(self.track.duration)
 
-        Returns:
-            AudioSource: An AudioSource object
+    @property
+    def position(self) -> float:
+        """Seconds played so far"""
+        return self.frames * pcm.FRAME_LENGTH
+
+    @property
+    def remaining(self) -> float:
+        """Seconds until the end of the track (according to its duration)"""
+        return max(0.0, self.track.duration - self.position)
+
+    def read(self) -> bytes:
+        if self.suspended:
+            # The player may read once more right after the pause. An empty frame would end the track
+            return ra.OPUS_SILENCE if self.is_opus() else ra.PCM_SILENCE
+        padded = self._padded_frames()
+        # "suspend" may replace the FFmpeg source while it is being read
+        original = self.original
+        if self._processor is None:
+            # Opus packets go straight to the voice connection. Nothing is decoded or encoded in the bot process
+            data = self.original.read()
+        else:
+            data = self._processor.read()
+            if self._crossfade_source is not None and data and self.track.duration > 0 and self.remaining <= self._crossfade_frames * pcm.FRAME_LENGTH:
+                data = self._mix_crossfade(data)
+        if data:
+            if self._padded_frames() == padded:
+                self.frames += 1
+            else:
+                self.silent_frames += 1
+        elif self.suspended or original is not self.original:
+            # The source was stopped on purpose (e.g. by a seek). That is not the end of the track
+            return ra.OPUS_SILENCE if self.is_opus() else ra.PCM_SILENCE
+        elif self._interrupted():
+            # Keep the track alive with silence while it is restarted from its position
+            logger.info(f'The stream of "{self.title}" broke at {self.position:.1f}s')
+            self.suspend()
+            self.on_interrupted()
+            return ra.OPUS_SILENCE if self.is_opus() else ra.PCM_SILENCE
+        return data
+
+    def _interrupted(self) -> bool:
+        """Whether the stream ended well before the duration of the track (e.g. the connection to the stream was lost)"""
+        return (
+            self.on_interrupted is not None
+            and self.factory is not None
+            and self.track.duration > 0
+            and self.remaining > MIN_INTERRUPTED_REMAINING
+            and self.restarts < MAX_RESTARTS
+        )
+
+    def crossfade_into(self, source: AudioSource, seconds: float) -> None:
+        """Mix the beginning of the next source into the last seconds of this one
+
+        The next source keeps its position, so it continues from the end of the crossfade when it starts playing.
+        Only PCM sources can be mixed.
         """
-        with youtube_dl.YoutubeDL(ytdl_options) as ytdl:
-            partial = functools.partial(ytdl.extract_info, search, download=False, process=False)
-            data = await asyncio.get_event_loop().run_in_executor(None, partial)
+        if self._processor is None or source._processor is None:
+            return
+        self._crossfade_source = source
+        self._crossfade_frames = int(seconds / pcm.FRAME_LENGTH)
+        self._processor.fade_out_frames = max(self._processor.fade_out_frames, self._crossfade_frames)
+        source._processor.fade_in_frames = max(source._processor.fade_in_frames, self._crossfade_frames)
+
+    def cancel_crossfade(self) -> None:
+        """Stop mixing the next source in. The fade out already applied to this one is kept"""
+        self._crossfade_source = None
+
+    def _mix_crossfade(self, data: bytes) -> bytes:
+        try:
+            other = self._crossfade_source.read()
+        except Exception:
+            # The next source was discarded meanwhile (e.g. the queue was cleared)
+            other = b''
+        if not other:
+            self._crossfade_source = None
+            return data
+        return pcm.mix(data, other)
+
+    def _padded_frames(self) -> int:
+        return self.original.silent_frames if isinstance(self.original, ra.ReadAheadBuffer) else 0
 
-        if data is None:
-            raise ce.YTDLError(f'Couldn\'t find anything that matches "{search}"')
+    @property
+    def buffer_stats(self) -> dict[str, float] | None:
+        """Underruns and fill level of the read-ahead buffer (if any), and the silence sent on the whole track"""
+        if not isinstance(self.original, ra.ReadAheadBuffer):
+            return None
+        return self.original.stats | {'silent_frames': self.silent_frames, 'silence': self.silent_frames * pcm.FRAME_LENGTH}
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self) -> None:
+        self.closed = True
+        self.original.cleanup()
+        if self.silent_frames:
+            logger.info(f'"{self.title}" ended with {self.silent_frames * pcm.FRAME_LENGTH:.1f}s of silence, as its stream did not keep up')
+
+    def suspend(self) -> None:
+        """Stop the FFmpeg process (and its read ahead) of a paused source, keeping its position to restart from it"""
+        if self.suspended or self.factory is None:
+            return
+        self.suspended = True
+        self._crossfade_source = None
+        self.original.cleanup()
+
+    def restart(self, position: float | None = None) -> None:
+        """Start a new FFmpeg process of a suspended source
 
-        if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = next((entry for entry in data['entries'] if entry), None)
-            if process_info is None:
-                raise ce.YTDLError(f"Couldn\'t find anything that matches `{search}`")
+        Args:
+            position (float | None, optional): Second to start from. Defaults to where the source was suspended.
+        """
+        if not self.suspended or self.closed:
+            return
+        if position is not None:
+            self.frames = int(max(0.0, min(position, self.track.duration or position)) / pcm.FRAME_LENGTH)
+        # Fast input seeking on the already resolved stream
+        original = self.factory(self.position)
+        if READ_AHEAD:
+            original = ra.ReadAheadBuffer(original, READ_AHEAD)
+        self.original = original
+        self._processor = self._create_processor(original, self.position)
+        self.suspended = False
 
-        webpage_url = process_info['webpage_url']
-        with youtube_dl.YoutubeDL(ytdl_options) as ytdl:
-            partial = functools.partial(ytdl.extract_info, webpage_url, download=False)
-            processed_info = await asyncio.get_event_loop().run_in_executor(None, partial)
+    @classmethod
+    def from_track(cls, track: ti.TrackInfo, requester: discord.Member, channel: discord.abc.Messageable, ffmpeg_options: dict = FFMPEG_OPTIONS, volume: float = DEFAULT_VOLUME) -> AudioSource:
+        """Creates a AudioSource from an already resolved track. Starts the FFmpeg process
 
-        if processed_info is None:
-            raise ce.YTDLError(f"Couldn\'t fetch `{webpage_url}`")
+        On the "opus" playback mode, Opus streams at full volume are copied straight through.
+        Other streams are encoded to Opus by FFmpeg (out of the bot process), with the volume as an FFmpeg filter.
+        On the "pcm" playback mode, FFmpeg decodes to PCM and the volume and the Opus encoding are done in the bot process.
 
-        if 'entries' not in processed_info:
-            info = processed_info
+        With broadcasting enabled, voice clients playing the same stream at the same time share a single FFmpeg process.
+        With read ahead enabled, a thread keeps some seconds of audio buffered ahead of the voice send loop.
+        """
+        if track.is_local and ffmpeg_options is FFMPEG_OPTIONS:
+            ffmpeg_options = LOCAL_FFMPEG_OPTIONS
+        baked_volume = volume if PLAYBACK_MODE == 'opus' else None
+        factory = functools.partial(cls.create_original, track, ffmpeg_options, baked_volume)
+        if BROADCAST_HUB is None:
+            original = factory(0)
         else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError as e:
-                    raise ce.YTDLError(f"Couldn\'t retrieve any matches for `{webpage_url}`") from e
-
-        context_data = {
-            'requester': ctx.author,
-            'channel': ctx.channel
-        }
+            # PCM broadcasts are shared by every volume (applied per subscriber). Opus ones only by the same baked volume and gain
+            gain = track.gain if baked_volume is not None else None
+            original = BROADCAST_HUB.subscribe((track.stream_url, 0, baked_volume, gain), 0, factory)
+        if READ_AHEAD:
+            original = ra.ReadAheadBuffer(original, READ_AHEAD)
+        return cls(original, volume=volume, track=track, requester=requester, channel=channel, baked_volume=baked_volume, factory=factory)
 
-        return cls(discord.FFmpegPCMAudio(info['url'], **ffmpeg_options), volume=volume, source_data=info | context_data)
+    @classmethod
+    def create_original(cls, track: ti.TrackInfo, ffmpeg_options: dict, baked_volume: float | None, start: float = 0) -> discord.FFmpegAudio:
+        """Start the FFmpeg process of a resolved track
 
-    # TODO: bulk AudioSource creation for playlists
+        Args:
+            track (ti.TrackInfo): The resolved track
+            ffmpeg_options (dict): Options to pass to FFMPEG
+            baked_volume (float | None): The volume FFmpeg applies to an Opus output (along with the loudness gain of the track). None for a PCM output
+            start (float, optional): Seconds to skip from the beginning of the stream. Defaults to 0.
+        """
+        if start:
+            # Before the input, so FFmpeg seeks the input instead of decoding and discarding
+            ffmpeg_options = ffmpeg_options | {'before_options': f'-ss {start:.2f} {ffmpeg_options.get("before_options", "")}'}
+
+        if baked_volume is None:
+            return discord.FFmpegPCMAudio(track.stream_url, **ffmpeg_options)
+        level = baked_volume * track.gain
+        if track.codec == 'opus' and level == 1.0:
+            return discord.FFmpegOpusAudio(track.stream_url, codec='opus', **ffmpeg_options)
+        options = f'{ffmpeg_options.get("options", "")} -af volume={level:.3f}'
+        return discord.FFmpegOpusAudio(track.stream_url, **(ffmpeg_options | {'options': options}))
 
     @staticmethod
     def parse_duration(duration: int) -> str:
@@ -206,73 +649,372 @@ class AudioSource(discord.PCMVolumeTransformer):
         return ', '.join(times)
 
 
-class AudioQueue(asyncio.Queue[AudioSource]):
-    # TODO: test the maxsize
-    def _init(self, maxsize) -> None:
-        self._queue: t.Deque[AudioSource] = collections.deque()
+class QueueEntry:
+    """A lightweight pending track of the AudioQueue
+
+    The entry is resolved in the background by the queue and only gets a live FFmpeg source when it is close to be played
+    """
 
-    #######################
-    ### ATTENTION BELOW ###
-    #######################
-    # Carefully overwriting these methods
-    async def put(self, item) -> AudioSource:
-        """Put an item into the queue.
+    def __init__(self, search: str, requester: discord.Member, channel: discord.abc.Messageable, title: str | None = None) -> None:
+        self.search = search
+        self.requester = requester
+        self.channel = channel
+        # A title known before the resolution (e.g. from a flat playlist extraction)
+        self.pending_title = title
+        self.info: ti.TrackInfo | None = None
+        # The bitrate (bps) the stream was picked for
+        self.bitrate: int | None = None
+        self.source: AudioSource | None = None
+        # Loads or measures the loudness gain of the track (see "load_gain")
+        self._gain_task: asyncio.Task | None = None
+        self._gain_callback: t.Callable[[float], None] | None = None
+        self._resolution: asyncio.Future[ti.TrackInfo] = asyncio.get_running_loop().create_future()
+
+    @classmethod
+    def from_context(cls, ctx: cc.CustomContext, search: str) -> QueueEntry:
+        return cls(search, ctx.author, ctx.channel)
+
+    @classmethod
+    def from_playlist_entry(cls, ctx: cc.CustomContext, entry: dict) -> QueueEntry:
+        return cls(entry.get('webpage_url') or entry['url'], ctx.author, ctx.channel, title=entry.get('title'))
+
+    @classmethod
+    def from_track(cls, ctx: cc.CustomContext, track: ti.TrackInfo) -> QueueEntry:
+        """An entry of an already resolved track (e.g. a file of the local library). It never goes through yt-dlp"""
+        entry = cls(track.webpage_url, ctx.author, ctx.channel, title=track.title)
+        entry.info = track
+        entry._resolution.set_result(track)
+        return entry
 
-        Put an item into the queue. If the queue is full, wait until a free
-        slot is available before adding item.
+    @property
+    def title(self) -> str:
+        return self.info.title if self.info else self.pending_title or self.search
+
+    @property
+    def memory_size(self) -> int:
+        """Approximate amount of bytes the entry keeps alive"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.search)
+        if self.info is not None:
+            size += self.info.memory_size
+        return size
+
+    @property
+    def resolved(self) -> bool:
+        return self._resolution.done() and not self._resolution.cancelled() and self._resolution.exception() is None
+
+    @property
+    def failed(self) -> bool:
+        return self._resolution.done() and (self._resolution.cancelled() or self._resolution.exception() is not None)
+
+    async def resolve(self, semaphore: asyncio.Semaphore, bitrate: int | None = None) -> None:
+        """Resolve the search of the entry. Errors are stored and raised to who waits for the entry
+
+        Args:
+            semaphore (asyncio.Semaphore): Bounds the concurrent resolutions
+            bitrate (int | None, optional): The bitrate (bps) of the voice channel, to pick the audio format. Defaults to None.
         """
-        while self.full():
-            putter = self._get_loop().create_future()
-            self._putters.append(putter)
-            try:
-                await putter
-            except:
-                putter.cancel()
-                with contextlib.suppress(ValueError):
-                    self._putters.remove(putter)
-                if not self.full() and not putter.cancelled():
-                    self._wakeup_next(self._putters)
-                raise
-        # Calling here with "await" keyword
-        return await self.put_nowait(item)
-
-    async def put_nowait(self, item) -> AudioSource:
-        """Put an item into the queue without blocking.
-
-        If no free slot is immediately available, raise QueueFull.
+        self.bitrate = bitrate
+        if self._resolution.done():
+            return
+        try:
+            async with semaphore:
+                # The entry may have been cancelled while waiting for its turn
+                if self._resolution.done():
+                    return
+                # Only the compact track is kept. The info dict is dropped by the resolver
+                info = await TRACK_RESOLVER.resolve(self.search, bitrate)
+                TRACK_INDEX.add(info.webpage_url, info.title)
+        except Exception as error:
+            if not self._resolution.done():
+                self._resolution.set_exception(error)
+        else:
+            if not self._resolution.done():
+                self.info = info
+                self._resolution.set_result(info)
+
+    async def wait_resolved(self) -> ti.TrackInfo:
+        try:
+            return await asyncio.shield(self._resolution)
+        except asyncio.CancelledError:
+            # Only translate the cancellation of the entry itself, not the cancellation of who is waiting
+            if self._resolution.cancelled():
+                raise ce.YTDLError(f'"{self.search}" was removed from the queue') from None
+            raise
+
+    def prepare_source(self, volume: float = DEFAULT_VOLUME) -> None:
+        """Start the FFmpeg source of a resolved entry ahead of its turn"""
+        if self.source is None and self.resolved and not self._stream_expired():
+            self.load_gain()
+            self.source = AudioSource.from_track(self.info, self.requester, self.channel, volume=volume)
+
+    async def create_source(self, volume: float = DEFAULT_VOLUME) -> AudioSource:
+        """Get a playable AudioSource for the entry
+
+        Uses the prepared source if there is one. Re-resolves the stream url if it expired while the entry was waiting.
+
+        Raises:
+            ce.YTDLError: When the entry could not be resolved.
         """
-        if self.full():
-            raise QueueFull
-        # calling here with "await" keyword and get the return value of "_put" to return
-        item = await self._put(item)
-        self._unfinished_tasks += 1
-        self._finished.clear()
-        self._wakeup_next(self._getters)
-        # Returning the "_put" value
-        return item
-    #######################
-    ### ATTENTION ABOVE ###
-    #######################
-
-    async def _put(self, item: AudioSource | tuple[commands.Context, str]) -> AudioSource:
-        if isinstance(item, AudioSource):
-            self._queue.append(item)
-            r = item
+        if self.source is not None:
+            source, self.source = self.source, None
+            if source.baked_volume in (None, volume):
+                return source
+            # An Opus source prepared with an old volume
+            source.cleanup()
+
+        info = await self.wait_resolved()
+        if self._stream_expired():
+            # The cache knows that only the stream url must be re-resolved
+            fresh = ti.TrackInfo.from_info(await RESOLVER.resolve(info.webpage_url, self.bitrate))
+            fresh.gain = info.gain
+            info = self.info = fresh
+        self.load_gain()
+        return AudioSource.from_track(info, self.requester, self.channel, volume=volume)
+
+    async def refresh(self) -> None:
+        """Re-resolve the stream url of the entry if it expired. The track object is kept, so its sources see the new url
+
+        Raises:
+            ce.YTDLError: When the stream could not be resolved again.
+        """
+        if self.info is None or not self._stream_expired():
+            return
+        fresh = ti.TrackInfo.from_info(await RESOLVER.resolve(self.info.webpage_url, self.bitrate))
+        self.info.stream_url = fresh.stream_url
+
+    def load_gain(self) -> None:
+        """Set the stored loudness gain of a resolved entry, or measure it in the background if it was never measured
+
+        Only the entries about to be played are measured. The measurement is cancelled if the entry leaves the queue.
+        """
+        if LOUDNESS is None or self._gain_task is not None or not self.resolved:
+            return
+        self._gain_task = asyncio.create_task(self._load_gain(self.info.webpage_url, self.info.stream_url))
+
+    async def _load_gain(self, webpage_url: str, stream_url: str) -> None:
+        loop = asyncio.get_running_loop()
+        # The on-disk cache is not read on the event loop
+        gain = await loop.run_in_executor(None, AUDIO_CACHE.get_gain, webpage_url)
+        if gain is not None:
+            self.info.gain = gain
+            return
+
+        def store(gain: float) -> None:
+            self._gain_callback = None
+            loop.run_in_executor(None, AUDIO_CACHE.put_gain, webpage_url, gain)
+            # Applies to the sources created from now on
+            self.info.gain = gain
+        self._gain_callback = store
+        LOUDNESS.schedule(webpage_url, stream_url, store)
+
+    def discard_source(self) -> None:
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+    def cancel(self) -> None:
+        self.discard_source()
+        if self._gain_task is not None:
+            self._gain_task.cancel()
+        if self._gain_callback is not None:
+            LOUDNESS.cancel(self.info.webpage_url, self._gain_callback)
+            self._gain_callback = None
+        if not self._resolution.done():
+            self._resolution.cancel()
+
+    def _stream_expired(self) -> bool:
+        return AUDIO_CACHE.stream_expiry(self.info.stream_url) - AUDIO_CACHE.expiry_margin < time.time()
+
+
+class AudioQueue(asyncio.Queue[QueueEntry]):
+    """Queue of lazy QueueEntry objects
+
+    Entries are resolved in the background in parallel (bounded), while their order in the queue is kept.
+    Only the first "lookahead" entries get a live FFmpeg source.
+    The entries are kept in an IndexedList, so positional operations and pages stay cheap on queues of thousands of entries.
+    Besides the "maxsize", the queue is full when its entries take more than "max_memory" bytes (approximately).
+    """
+
+    def __init__(self, maxsize: int = 0, *, max_memory: int = 0, lookahead: int = 1, resolve_concurrency: int = 3) -> None:
+        super().__init__(maxsize)
+        self.max_memory = max_memory
+        self.lookahead = lookahead
+        # Whether the first entry must have a live source, even without lookahead (see CustomVoiceClient.preroll)
+        self.preroll = False
+        # While nobody is listening, no source is prepared (see CustomVoiceClient.suspend)
+        self.suspended = False
+        # The bitrate (bps) of the voice channel. Set by the voice client
+        self.bitrate: int | None = None
+        self._volume = DEFAULT_VOLUME
+        self._resolve_semaphore = asyncio.Semaphore(resolve_concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    def _init(self, maxsize) -> None:
+        self._queue: il.IndexedList[QueueEntry] = il.IndexedList()
+        self._memory = 0
+        self._sizes: dict[QueueEntry, int] = {}
+        self._info_size_estimate = 1024
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    def full(self) -> bool:
+        if 0 < self.max_memory <= self._memory:
+            return True
+        return super().full()
+
+    def _get(self) -> QueueEntry:
+        entry = self._queue.popleft()
+        self._forget(entry)
+        return entry
+
+    def _put(self, item: QueueEntry | tuple[commands.Context, str]) -> None:
         if isinstance(item, tuple) and isinstance(item[0], commands.Context) and isinstance(item[1], str):
-            source = await AudioSource.create_source(item[0], item[1])
-            self._queue.append(source)
-            r = source
-        else:
+            item = QueueEntry.from_context(*item)
+        if not isinstance(item, QueueEntry):
             raise TypeError(f'Cannot store type {type(item)} in this queue')
-        return r
+        self._queue.append(item)
+        self._account(item)
+        task = asyncio.create_task(self._resolve(item))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, entry: QueueEntry) -> None:
+        await entry.resolve(self._resolve_semaphore, self.bitrate)
+        if entry.failed:
+            with contextlib.suppress(ValueError):
+                self._queue.remove(entry)
+            self._forget(entry)
+            if not entry._resolution.cancelled():
+                error = entry._resolution.exception()
+                logger.info(f'Failed to resolve "{entry.search}": {error}')
+                with contextlib.suppress(discord.HTTPException):
+                    await entry.channel.send(f'{entry.requester.mention} Couldn\'t enqueue "{entry.search}": {error}')
+            return
+        # The resolved info takes more memory than the pending entry
+        if entry in self._sizes:
+            self._account(entry)
+        self.prefetch()
+
+    @property
+    def volume(self) -> float:
+        """The volume of the prepared sources"""
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float) -> None:
+        self._volume = value
+        for entry in itertools.islice(self._queue, self.prepared_count):
+            if entry.source is not None and entry.source.baked_volume not in (None, value):
+                entry.discard_source()
+        self.prefetch()
+
+    @property
+    def prepared_count(self) -> int:
+        """Amount of entries at the front of the queue that get a live FFmpeg source"""
+        if self.suspended:
+            return 0
+        return max(self.lookahead, int(self.preroll))
+
+    def peek(self) -> QueueEntry | None:
+        return self._queue[0] if self._queue else None
+
+    def page(self, start: int, stop: int) -> list[QueueEntry]:
+        """The entries in [start, stop). Only those entries are visited"""
+        return self._queue.slice(start, stop)
+
+    def prefetch(self) -> None:
+        """Make sure only the next "lookahead" entries have a live FFmpeg source"""
+        lookahead = self.prepared_count
+        if not self.suspended and (head := self.peek()) is not None:
+            # Measured ahead, even if its source is only started at the preroll of the current track
+            head.load_gain()
+        for index, entry in enumerate(self._queue):
+            if index < lookahead:
+                entry.prepare_source(self._volume)
+            elif entry.source is not None:
+                entry.discard_source()
+            else:
+                # Sources are only ever prepared at the front of the queue. There is nothing else to discard
+                break
+
+    def suspend(self) -> None:
+        """Discard the prepared sources and prepare none until "resume" """
+        for entry in itertools.islice(self._queue, self.prepared_count):
+            entry.discard_source()
+        self.suspended = True
+
+    def resume(self) -> None:
+        self.suspended = False
+        self.prefetch()
+
+    def _account(self, entry: QueueEntry) -> None:
+        size = entry.memory_size
+        if entry.info is None:
+            # Count pending entries with the size they will have once resolved, so the limit holds after the resolutions
+            size += self._info_size_estimate
+        else:
+            # Moving average of the resolved entries sizes
+            self._info_size_estimate += (size - self._info_size_estimate) // 8
+        self._memory += size - self._sizes.get(entry, 0)
+        self._sizes[entry] = size
+
+    def _forget(self, entry: QueueEntry) -> None:
+        self._memory -= self._sizes.pop(entry, 0)
+        # Freed memory may unblock putters
+        self._wakeup_next(self._putters)
+
     def clear(self) -> None:
+        for entry in self._queue:
+            entry.cancel()
         self._queue.clear()
+        self._sizes.clear()
+        self._memory = 0
+        self._wakeup_next(self._putters)
 
     def shuffle(self) -> None:
-        random.shuffle(self._queue)
+        # Only the front of the queue has sources
+        for entry in itertools.islice(self._queue, self.prepared_count):
+            entry.discard_source()
+        # Lazy. The new order is only decided as the entries are reached
+        self._queue.shuffle()
+        self.prefetch()
 
-    def remove(self, index: int) -> None:
-        if 0 <= index < len(self._queue):
-            del self._queue[index]
-        else:
-            raise IndexError("Index out of range")
+    def remove(self, index: int) -> QueueEntry:
+        """Remove the entry at an index
+
+        Raises:
+            IndexError: When there is no entry at the index.
+        """
+        entry = self._queue.pop(index)
+        entry.cancel()
+        self._forget(entry)
+        self.prefetch()
+        return entry
+
+    def move(self, source: int, destination: int) -> QueueEntry:
+        """Move the entry at "source" to "destination"
+
+        Raises:
+            IndexError: When there is no entry at any of the indexes.
+        """
+        entry = self._queue[source]
+        self._queue.move(source, destination)
+        if destination >= self.prepared_count:
+            entry.discard_source()
+        self.prefetch()
+        return entry
+
+    def jump(self, index: int) -> QueueEntry:
+        """Remove the entries before an index, so the entry at the index is the next one
+
+        Raises:
+            IndexError: When there is no entry at the index.
+        """
+        entry = self._queue[index]
+        for skipped in self._queue.delete_range(0, index):
+            skipped.cancel()
+            self._forget(skipped)
+        self.prefetch()
+        return entry
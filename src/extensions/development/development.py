@@ -6,6 +6,7 @@ from discord.ext import commands
 import bot_yerak as by
 import custom_context as cc
 import custom_errors as ce
+import custom_voice_client as cvc
 import extensions as exts
 from settings import settings
 
@@ -76,6 +77,16 @@ class Development(commands.Cog, command_attrs=dict(hidden=True)):
         else:
             await ctx.reply('Not closing the bot')
 
+    @commands.command(**get_command_attributes('resolver_stats'))
+    async def resolver_stats(self, ctx: cc.CustomContext) -> None:
+        columns = ('hits', 'misses', 'errors', 'cancelled', 'p50', 'p95', 'p99')
+        lines = [f'{"resolver":<10}' + ''.join(f'{column:>10}' for column in columns)]
+        for name, stats in cvc.TRACK_RESOLVER.summary.items():
+            lines.append(f'{name:<10}' + ''.join(f'{"-" if stats[column] is None else stats[column]:>10}' for column in columns))
+        lines.append('')
+        lines.append('cache ' + ', '.join(f'{name}={value}' for name, value in cvc.AUDIO_CACHE.stats.items()))
+        await ctx.reply('Latencies in ms\n```\n' + '\n'.join(lines) + '\n```')
+
     def _format_extensions_message(self, result: dict[str, list], action: str) -> str:
         success_message = f'Extension(s): "{", ".join(result["success"])}" {action}ed successfully' if result["success"] else ''
         failure_message = f'Failed to {action} the extension(s): "{", ".join([f"{fail[0]} -> {fail[1]}" for fail in result["fail"]])}"' if result["fail"] else ''
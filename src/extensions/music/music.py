@@ -1,10 +1,13 @@
+import asyncio
+import contextlib
 import functools
 import logging
 import typing as t
 from pathlib import Path
 
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
 
 import bot_yerak as by
 import custom_context as cc
@@ -16,6 +19,7 @@ logger = logging.getLogger(__name__)
 
 THIS_FOLDER = Path(__file__).parent
 FFMPEG_PATH = THIS_FOLDER/'ffmpeg.exe'
+QUEUE_PAGE_SIZE = 10
 
 _commands_attributes = exts.read_commands_attributes(THIS_FOLDER/'commands_attr.json')  # Global cache for config data
 get_command_attributes = exts.get_command_attributes_builder(_commands_attributes)
@@ -53,24 +57,97 @@ def ensure_bot_paused() -> t.Callable[[cc.CustomContext], bool]:
     return commands.check(predicate)
 
 
+def ensure_queue_not_empty() -> t.Callable[[cc.CustomContext], bool]:
+    def predicate(ctx: cc.CustomContext):
+        voice = ctx.voice_client
+        return voice and not voice.queue.empty()
+    return commands.check(predicate)
+
+
+def parse_timestamp(text: str) -> float:
+    """Seconds of a "[[hours:]minutes:]seconds" timestamp"""
+    seconds = 0.0
+    try:
+        for part in text.strip().split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        raise commands.BadArgument(f'"{text}" is not a valid timestamp') from None
+    if seconds < 0:
+        raise commands.BadArgument('The timestamp must be positive')
+    return seconds
+
+
+def queue_index(queue: cvc.AudioQueue, position: int) -> int:
+    # Positions shown to the users start at 1
+    if not 1 <= position <= queue.qsize():
+        raise ce.QueuePositionError(f'There is no song at position {position}. The queue has {queue.qsize()} songs')
+    return position - 1
+
+
+class QueuePageView(discord.ui.View):
+    """Previous and next buttons for the queue embed. Each page is rendered only when it is shown"""
+
+    def __init__(self, cog: 'Music', queue: cvc.AudioQueue, author: discord.abc.User, page: int) -> None:
+        super().__init__(timeout=120)
+        self.cog = cog
+        self.queue = queue
+        self.author = author
+        self.page = page
+        self.message: discord.Message | None = None
+        self.update_buttons()
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.queue.qsize() // QUEUE_PAGE_SIZE))
+
+    def update_buttons(self) -> None:
+        self.page = max(0, min(self.page, self.pages - 1))
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page >= self.pages - 1
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user == self.author
+
+    async def on_timeout(self) -> None:
+        if self.message is not None:
+            with contextlib.suppress(discord.HTTPException):
+                await self.message.edit(view=None)
+
+    async def show_page(self, interaction: discord.Interaction, page: int) -> None:
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.cog.create_queue_embed(self.queue, self.page), view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show_page(interaction, self.page + 1)
+
+
 # TODO: there is a logging error some times
 # ☑ enter
 # ☑ leave
 # ☑ play/enqueue
-# add_playlist
+# ☑ add_playlist
 # ☑ pause
 # ☑ resume
 # ☑ stop
 # ☑ skip
 # ☑ volume
-# goto
+# ☑ goto
 # lyrics
 # ☑ loop
 # ☑ now_playing
-# queue
+# ☑ queue
 # ☑ clear
-# shuffle
-# delete
+# ☑ shuffle
+# ☑ delete
+# ☑ move
+# ☑ seek
+# ☑ play_local
 
 class Music(commands.GroupCog):
     """Play songs on a voice channel"""
@@ -78,6 +155,49 @@ class Music(commands.GroupCog):
     def __init__(self, bot: by.BotYerak) -> None:
         self.bot = bot
 
+    async def cog_load(self) -> None:
+        # Closed by a previous unload of the cog
+        cvc.AUDIO_CACHE.open()
+        # Start the extraction workers (if any) before the first play command
+        await cvc.RESOLVER.extractor.warm()
+        self.save_track_index.start()
+        if cvc.LIBRARY is not None:
+            self.scan_library.change_interval(seconds=cvc.LIBRARY_SCAN_INTERVAL)
+            self.scan_library.start()
+
+    async def cog_unload(self) -> None:
+        cvc.RESOLVER.extractor.close()
+        self.save_track_index.cancel()
+        self.scan_library.cancel()
+        cvc.TRACK_INDEX.save()
+        if cvc.LOUDNESS is not None:
+            await cvc.LOUDNESS.close()
+        cvc.AUDIO_CACHE.close()
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState) -> None:
+        voice = member.guild.voice_client
+        if not isinstance(voice, cvc.CustomVoiceClient) or before.channel == after.channel:
+            return
+        if voice.channel not in (before.channel, after.channel):
+            return
+        # Stop streaming to an empty channel. Resume when somebody comes back
+        listeners = [channel_member for channel_member in voice.channel.members if not channel_member.bot]
+        if listeners:
+            await voice.wake()
+        else:
+            voice.suspend()
+
+    @tasks.loop(minutes=5)
+    async def save_track_index(self) -> None:
+        if cvc.TRACK_INDEX.dirty:
+            await asyncio.get_running_loop().run_in_executor(None, cvc.TRACK_INDEX.save)
+
+    @tasks.loop(minutes=10)
+    async def scan_library(self) -> None:
+        # Incremental. Only the new and modified files are read
+        await cvc.LIBRARY.refresh()
+
     @commands.hybrid_command(**get_command_attributes('join'))
     @ensure_author_voice()
     async def join(self, ctx: cc.CustomContext) -> None:
@@ -90,7 +210,7 @@ class Music(commands.GroupCog):
                     client,
                     connectable,
                     timeout=180,
-                    on_play_callback=functools.partial(self.__now_playing, ctx),
+                    on_play_callback=functools.partial(self.__update_now_playing, ctx),
                 )
             )
         else:
@@ -124,31 +244,114 @@ class Music(commands.GroupCog):
     async def play(self, ctx: cc.CustomContext, *,
         search: str = commands.parameter(**get_command_parameters('play', 'search'))
     ) -> None:
-        async with ctx.typing():
-            # Put the audio in the queue. If this is the only audio in the queue, it will start automatically
-            source = await ctx.voice_client.queue.put((ctx, search))
-        await ctx.reply(f'Enqueued "{source.title}"')
+        # Put the audio in the queue. If this is the only audio in the queue, it will start automatically as soon as it is resolved.
+        # The resolution happens in the background, so there is no need to wait for it here
+        entry = cvc.QueueEntry.from_context(ctx, search)
+        try:
+            ctx.voice_client.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            await ctx.reply('The queue is full')
+            return
+        await ctx.reply(f'Enqueued "{entry.title}"')
         
+    @play.autocomplete('search')
+    async def play_search_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        # Answered from the local index only. A yt-dlp search would not fit in the autocomplete deadline
+        return [
+            app_commands.Choice(name=track.title[:100], value=track.url)
+            for track in cvc.TRACK_INDEX.search(current, limit=25)
+            if len(track.url) <= 100
+        ]
+
     @play.error
     async def on_play_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
-        # sourcery skip: remove-unnecessary-else, swap-if-else-branches
         if isinstance(error, ce.NoVoiceChannelError):
-            # Try to invoke a join command and invoke the play command again
-            # Not using "ctx.invoke" because it bypasses the checks and errors handlers
-            join_message = ctx.message
-            join_message.content = f'{(await self.bot.get_prefix(join_message))[0]}join'
-            join_context = await self.bot.get_context(join_message)
-            await self.bot.invoke(join_context)
-            if join_context.command_failed:
-                # If the join command could not be invoked successfully, just ignore.
-                # The error handler of the join command will take care of it
-                return
-            else:
-                # Try to invoke the command again.
-                await self.bot.invoke(ctx)
+            await self.join_and_reinvoke(ctx)
+        else:
+            raise error
+
+    @commands.hybrid_command(**get_command_attributes('play_local'))
+    @ensure_bot_voice()
+    async def play_local(self, ctx: cc.CustomContext, *,
+        search: str = commands.parameter(**get_command_parameters('play_local', 'search'))
+    ) -> None:
+        if cvc.LIBRARY is None:
+            await ctx.reply('There is no local library')
+            return
+        # The autocomplete sends the path of the file. A typed search plays the best match
+        track = cvc.LIBRARY.get(search) or next(iter(cvc.LIBRARY.search(search, limit=1)), None)
+        if track is None:
+            await ctx.reply(f'No local song matches "{search}"')
+            return
+        entry = cvc.QueueEntry.from_track(ctx, cvc.LIBRARY.track_info(track))
+        try:
+            ctx.voice_client.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            await ctx.reply('The queue is full')
+            return
+        await ctx.reply(f'Enqueued "{entry.title}"')
+
+    @play_local.autocomplete('search')
+    async def play_local_search_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        if cvc.LIBRARY is None:
+            return []
+        return [
+            app_commands.Choice(name=track.display_title[:100], value=track.path)
+            for track in cvc.LIBRARY.search(current, limit=25)
+            if len(track.path) <= 100
+        ]
+
+    @play_local.error
+    async def on_play_local_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
+        if isinstance(error, ce.NoVoiceChannelError):
+            await self.join_and_reinvoke(ctx)
         else:
             raise error
 
+    @commands.hybrid_command(**get_command_attributes('add_playlist'))
+    @ensure_bot_voice()
+    async def add_playlist(self, ctx: cc.CustomContext, *,
+        url: str = commands.parameter(**get_command_parameters('add_playlist', 'url'))
+    ) -> None:
+        async with ctx.typing():
+            # A single flat extraction. The entries are resolved by the queue in the background (with bounded concurrency)
+            # so the first song starts as soon as it is resolved, without waiting for the whole playlist
+            title, playlist_entries = await cvc.RESOLVER.resolve_playlist(url)
+        enqueued = 0
+        for playlist_entry in playlist_entries:
+            try:
+                ctx.voice_client.queue.put_nowait(cvc.QueueEntry.from_playlist_entry(ctx, playlist_entry))
+            except asyncio.QueueFull:
+                break
+            enqueued += 1
+        message = f'Enqueued {enqueued} songs from "{title}"'
+        if enqueued < len(playlist_entries):
+            message += f'. The queue is full, {len(playlist_entries) - enqueued} songs were left out'
+        await ctx.reply(message)
+
+    @add_playlist.error
+    async def on_add_playlist_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
+        if isinstance(error, ce.NoVoiceChannelError):
+            await self.join_and_reinvoke(ctx)
+        else:
+            raise error
+
+    async def join_and_reinvoke(self, ctx: cc.CustomContext) -> None:
+        # sourcery skip: remove-unnecessary-else, swap-if-else-branches
+        # Try to invoke a join command and invoke the command again
+        # Not using "ctx.invoke" because it bypasses the checks and errors handlers
+        join_message = ctx.message
+        join_message.content = f'{(await self.bot.get_prefix(join_message))[0]}join'
+        join_context = await self.bot.get_context(join_message)
+        await self.bot.invoke(join_context)
+        if join_context.command_failed:
+            # If the join command could not be invoked successfully, just ignore.
+            # The error handler of the join command will take care of it
+            return
+        else:
+            # Try to invoke the command again.
+            await self.bot.invoke(ctx)
+
     @commands.hybrid_command(**get_command_attributes('pause'))
     @ensure_bot_playing()
     async def pause(self, ctx: cc.CustomContext) -> None:
@@ -165,7 +368,8 @@ class Music(commands.GroupCog):
     @commands.hybrid_command(**get_command_attributes('resume'))
     @ensure_bot_paused()
     async def resume(self, ctx: cc.CustomContext) -> None:
-        ctx.voice_client.resume()
+        # Restarts the source if it was suspended while nobody was listening
+        await ctx.voice_client.resume_playback()
         await ctx.reply('Resumed')
 
     @resume.error
@@ -210,7 +414,10 @@ class Music(commands.GroupCog):
     ) -> None:
         volume = (max(0, min(volume, 100)))
         ctx.voice_client.volume = volume / 100
-        await ctx.reply(f'Volume set to {volume}')
+        if ctx.voice_client.current_audio.is_opus():
+            await ctx.reply(f'Volume set to {volume}. It applies from the next song')
+        else:
+            await ctx.reply(f'Volume set to {volume}')
         
     @volume.error
     async def on_volume_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
@@ -241,19 +448,158 @@ class Music(commands.GroupCog):
         else:
             raise error
         
+    @commands.hybrid_command(**get_command_attributes('seek'))
+    @ensure_bot_playing()
+    async def seek(self, ctx: cc.CustomContext,
+        timestamp: str = commands.parameter(**get_command_parameters('seek', 'timestamp'))
+    ) -> None:
+        position = await ctx.voice_client.seek(parse_timestamp(timestamp))
+        minutes, seconds = divmod(int(position), 60)
+        await ctx.reply(f'Seeked to {minutes}:{seconds:02d}')
+
+    @seek.error
+    async def on_seek_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
+        # sourcery skip: remove-unnecessary-else, swap-if-else-branches
+        error = getattr(error, 'original', error)
+        if isinstance(error, commands.CheckFailure):
+            await ctx.reply('The bot is not playing anything')
+            return
+        if isinstance(error, commands.BadArgument):
+            await ctx.reply('The timestamp must be like 90, 1:30 or 1:02:30')
+            return
+        else:
+            raise error
+
     @commands.hybrid_command(**get_command_attributes('clear'))
     async def clear(self, ctx: cc.CustomContext) -> None:
         ctx.voice_client.queue.clear() 
         await ctx.reply('Queue cleared')
+
+    @commands.hybrid_command(**get_command_attributes('queue'))
+    @ensure_queue_not_empty()
+    async def queue(self, ctx: cc.CustomContext,
+        page: int = commands.parameter(default=1, **get_command_parameters('queue', 'page'))
+    ) -> None:
+        view = QueuePageView(self, ctx.voice_client.queue, ctx.author, page - 1)
+        view.message = await ctx.reply(embed=self.create_queue_embed(view.queue, view.page), view=view)
+
+    @queue.error
+    async def on_queue_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
+        # sourcery skip: remove-unnecessary-else, swap-if-else-branches
+        if isinstance(error, commands.CheckFailure):
+            await ctx.reply('The queue is empty')
+            return
+        if isinstance(error, commands.BadArgument):
+            await ctx.reply('The page must be an integer number')
+            return
+        else:
+            raise error
+
+    @commands.hybrid_command(**get_command_attributes('goto'))
+    @ensure_queue_not_empty()
+    async def goto(self, ctx: cc.CustomContext,
+        position: int = commands.parameter(**get_command_parameters('goto', 'position'))
+    ) -> None:
+        queue = ctx.voice_client.queue
+        entry = queue.jump(queue_index(queue, position))
+        # Stopping the current song plays the next one, which now is the chosen one
+        ctx.voice_client.looping = False
+        ctx.voice_client.stop()
+        await ctx.reply(f'Jumped to "{entry.title}"')
+
+    @commands.hybrid_command(**get_command_attributes('delete'))
+    @ensure_queue_not_empty()
+    async def delete(self, ctx: cc.CustomContext,
+        position: int = commands.parameter(**get_command_parameters('delete', 'position'))
+    ) -> None:
+        queue = ctx.voice_client.queue
+        entry = queue.remove(queue_index(queue, position))
+        await ctx.reply(f'Removed "{entry.title}" from the queue')
+
+    @commands.hybrid_command(**get_command_attributes('move'))
+    @ensure_queue_not_empty()
+    async def move(self, ctx: cc.CustomContext,
+        source: int = commands.parameter(**get_command_parameters('move', 'source')),
+        destination: int = commands.parameter(**get_command_parameters('move', 'destination')),
+    ) -> None:
+        queue = ctx.voice_client.queue
+        entry = queue.move(queue_index(queue, source), queue_index(queue, destination))
+        await ctx.reply(f'Moved "{entry.title}" to position {destination}')
+
+    @goto.error
+    @delete.error
+    @move.error
+    async def on_queue_position_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
+        # sourcery skip: remove-unnecessary-else, swap-if-else-branches
+        error = getattr(error, 'original', error)
+        if isinstance(error, commands.CheckFailure):
+            await ctx.reply('The queue is empty')
+            return
+        if isinstance(error, commands.BadArgument):
+            await ctx.reply('The position must be an integer number')
+            return
+        if isinstance(error, ce.QueuePositionError):
+            await ctx.reply(str(error))
+            return
+        else:
+            raise error
+
+    @commands.hybrid_command(**get_command_attributes('shuffle'))
+    @ensure_queue_not_empty()
+    async def shuffle(self, ctx: cc.CustomContext) -> None:
+        ctx.voice_client.queue.shuffle()
+        await ctx.reply('Queue shuffled')
+
+    @shuffle.error
+    async def on_shuffle_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
+        if isinstance(error, commands.CheckFailure):
+            await ctx.reply('The queue is empty')
+        else:
+            raise error
+
+    def create_queue_embed(self, queue: cvc.AudioQueue, page: int) -> discord.Embed:
+        # Only the entries of the page are read from the queue
+        start = page * QUEUE_PAGE_SIZE
+        entries = queue.page(start, start + QUEUE_PAGE_SIZE)
+        lines = [
+            f'`{position}.` {entry.title}{"" if entry.resolved else " *(loading)*"}'
+            for position, entry in enumerate(entries, start=start + 1)
+        ]
+        pages = max(1, -(-queue.qsize() // QUEUE_PAGE_SIZE))
+        return (
+            discord.Embed(
+                title='Queue',
+                description='\n'.join(lines) or 'There are no songs on this page',
+                color=0x175639,
+            )
+            .set_footer(text=f'Page {page + 1}/{pages} · {queue.qsize()} songs')
+        )
         
-    async def __now_playing(self, ctx: cc.CustomContext):
+    async def __now_playing(self, ctx: cc.CustomContext) -> discord.Message:
         embed = self.create_embed(ctx.voice_client.current_audio)
-        await ctx.reply(embed=embed)
+        return await ctx.reply(embed=embed)
+
+    async def __update_now_playing(self, ctx: cc.CustomContext, previous: discord.Message | None) -> discord.Message | None:
+        # Called by the now playing dispatcher of the voice client, in the background
+        voice = ctx.voice_client
+        if voice is None or voice.current_audio is None:
+            return previous
+        embed = self.create_embed(voice.current_audio)
+        # Edit the previous message if it is still the last one of the channel. Otherwise a new one is easier to see
+        if previous is not None and previous.channel.last_message_id == previous.id:
+            try:
+                return await previous.edit(embed=embed)
+            except discord.NotFound:
+                pass
+        # Not a reply: the command message may be long gone, and interaction followups expire
+        return await ctx.channel.send(embed=embed)
         
     @commands.hybrid_command(**get_command_attributes('now_playing'))
     @ensure_bot_playing()
     async def now_playing(self, ctx: cc.CustomContext) -> None:
-        await self.__now_playing(ctx)
+        message = await self.__now_playing(ctx)
+        # Next tracks update this message
+        ctx.voice_client.now_playing.message = message
         
     @now_playing.error
     async def on_now_playing_error(self, ctx: cc.CustomContext, error: discord.DiscordException) -> None:
@@ -266,19 +612,32 @@ class Music(commands.GroupCog):
          
     def create_embed(self, audio: cvc.AudioSource):
         # TODO: make better embed
-        return (
+        track = audio.track
+        embed = (
             discord.Embed(
                 title='Now playing',
-                description=f'```\n{audio.title}\n```',
+                description=f'```\n{track.title}\n```',
                 color=0x175639,
             )
             .add_field(name='Duration', value=audio.duration, inline=False)
             .add_field(name='Requested by', value=audio.requester.mention, inline=False)
             .add_field(
                 name='Uploader',
-                value=f'[{audio.uploader}]({audio.uploader_url})',
+                value=f'[{track.uploader}]({track.uploader_url})' if track.uploader_url else track.uploader or 'Unknown',
                 inline=False
             )
-            .add_field(name='URL', value=f'[Click]({audio.url})'.format(self), inline=False)
-            .set_thumbnail(url=audio.thumbnail)
+        )
+        if (stats := audio.buffer_stats) is not None:
+            embed.add_field(
+                name='Buffer',
+                value=f'{stats["fill_level"]:.0%} full, {stats["silence"]:.1f}s of silence',
+                inline=False,
+            )
+        if track.is_local:
+            # A file of the local library. There is no page to link to
+            return embed.add_field(name='File', value=Path(track.stream_url).name, inline=False)
+        return (
+            embed
+            .add_field(name='URL', value=f'[Click]({track.webpage_url})'.format(self), inline=False)
+            .set_thumbnail(url=track.thumbnail)
         )
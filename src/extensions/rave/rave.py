@@ -1,20 +1,28 @@
+import asyncio
+import collections
 import colorsys
 import contextlib
-import itertools
+import functools
 import logging
-import random
+import math
 from pathlib import Path
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 import bot_yerak as by
 import custom_context as cc
 import extensions as exts
+import rate_limits as rl
+import rave_effects as rfx
+import rave_roles as rr
+import rave_scheduler as rs
+import role_assignment as ra
 
 logger = logging.getLogger(__name__)
 
 THIS_FOLDER = Path(__file__).parent
+CACHE_FOLDER = THIS_FOLDER.parent.parent/'.cache'
 
 
 _commands_attributes = exts.read_commands_attributes(THIS_FOLDER/'commands_attr.json')  # Global cache for config data
@@ -36,31 +44,102 @@ class Rave(commands.GroupCog):
     long_description = """
         Create top hierarchy roles and change their color dynamically, making the server very animated.
         Every rave has an 8 minutes timeout"""
-    # TODO: do not let two raves at the same time
-    # TODO: check how the rave behaves in different guilds
     def __init__(self, bot: by.BotYerak) -> None:
         self.bot = bot
         self.role_name = "Yerak's Raver"
+        # The rave roles of every guild, kept in sync by the role events
+        self.role_index = rr.RaveRoleIndex(self.role_name)
+        # Limits of the deletion of the rave roles left behind by interrupted raves, when the cog loads
+        self.reconcile_concurrency = 4
+        self.reconcile_budget = 60.0
         self.timeout = 480  # 480 seconds equals to 8 minutes
-        self.tasks = self.get_tasks()
-        self.setup_tasks()
+        # Runs the rave of every guild. Each guild has its own effect, pacing and timeout
+        self.scheduler = rs.RaveScheduler()
+        # Longest precomputed timeline of the effects that do not cycle by themselves (e.g. "crazy")
+        self.max_frames = 1024
+        # Gives and takes the rave roles. Interrupted assignments are resumed when the cog loads again
+        self.assigner = ra.RoleAssigner(bot.http, CACHE_FOLDER/'rave_role_jobs.json')
+        self.resume_task: asyncio.Task | None = None
         
     def cog_load(self) -> None:
         # Delete the global command attributes cache. After the cog has loaded, it is not needed anymore and can be deleted to save memory
         global _commands_attributes
         del _commands_attributes
+        self.resume_task = asyncio.create_task(self.resume_assignments())
+
+    async def resume_assignments(self) -> None:
+        await self.bot.wait_until_ready()
+        jobs = [job for job in self.assigner.load() if self.bot.get_guild(job.guild_id) is not None]
+        await self.delete_orphaned_roles(jobs)
+        if jobs:
+            logger.info(f'Resuming {len(jobs)} interrupted rave role assignments')
+            await asyncio.gather(*(self.assigner.run(job) for job in jobs), return_exceptions=True)
+
+    async def delete_orphaned_roles(self, jobs: list[ra.AssignmentJob]) -> None:
+        # Keep the roles of the running raves and the ones the interrupted assignments still give
+        kept = collections.defaultdict(set)
+        for job in jobs:
+            kept[job.guild_id].update(change.role_id for change in job.pending)
+        for guild_id, session in self.scheduler.sessions.items():
+            kept[guild_id].update(role.id for role in session.roles)
+        result = await rr.delete_orphans(
+            self.bot.guilds, self.role_index, lambda guild: kept.get(guild.id, ()),
+            self.reconcile_concurrency, self.reconcile_budget,
+        )
+        if result.deleted or result.failed or result.pending:
+            logger.info(f'Deleted {result.deleted} orphaned rave roles ({result.failed} failed, {result.pending} left for the next start)')
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role) -> None:
+        self.role_index.add(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        self.role_index.discard(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role) -> None:
+        if before.name != after.name:
+            self.role_index.update(after)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild) -> None:
+        self.role_index.forget(guild.id)
 
     @commands.hybrid_command(**get_command_attributes('suspend'))
     async def suspend(self, ctx: cc.CustomContext) -> None:
-        self.stop_tasks()
+        if self.scheduler.suspend(ctx.guild.id) is None:
+            await ctx.reply('No rave is running')
+            return
         await ctx.reply('Rave suspended')
 
+    @commands.hybrid_command(**get_command_attributes('resume'))
+    async def resume(self, ctx: cc.CustomContext) -> None:
+        if self.scheduler.resume(ctx.guild.id) is None:
+            await ctx.reply('No rave is running')
+            return
+        await ctx.reply('Rave resumed')
+
     @commands.hybrid_command(**get_command_attributes('quit'))
     async def quit(self, ctx: cc.CustomContext) -> None:
-        self.stop_tasks()
+        self.scheduler.stop(ctx.guild.id)
+        # Deleting the roles takes them from every member at once. The assignment would only add them back
+        self.assigner.discard(ctx.guild.id)
         await self.delete_roles(ctx.guild, all=True)
         await ctx.reply('Rave quit')
 
+    @commands.hybrid_command(**get_command_attributes('status'))
+    async def status(self, ctx: cc.CustomContext) -> None:
+        if (session := self.scheduler.sessions.get(ctx.guild.id)) is None:
+            await ctx.reply('No rave is running')
+            return
+        pacer, player = session.pacer, session.player
+        await ctx.reply(
+            f'{player.effect.name}{" (suspended)" if session.suspended else ""}: {pacer.achieved_fps:.2f} of {pacer.requested_fps:.2f} requested frames per second '
+            f'({pacer.sent} sent, {pacer.dropped} dropped, {pacer.elapsed:.0f}s). '
+            f'{player.sent} role edits, {player.suppressed} skipped as the color did not change'
+        )
+
     @commands.hybrid_command(**get_command_attributes('hue_cycle'))
     async def hue_cycle(self, ctx: cc.CustomContext,
         step: float = commands.parameter(**get_command_parameters('hue_cycle', 'step')),
@@ -68,26 +147,15 @@ class Rave(commands.GroupCog):
         *,
         members: list[discord.Member] | None = commands.parameter(converter=MemberListConverter, **get_command_parameters('hue_cycle', 'members'))
     ) -> None:
-        # Prepare roles
+        # Prepare roles. The effect starts while the members get them
         roles = await self.get_roles(ctx.guild, 1)
-        await self.apply_all_roles(roles, members or ctx.guild.members)
-        # Prepare task
-        self.hue_cycle_task.change_interval(seconds=speed)
-        self.hue_cycle_task.count = self.timeout // speed
-        self.hue_cycle_task.start(ctx, roles[0].id, step)
-        await ctx.reply('Hue Cycle rave started')
-
-    @tasks.loop(seconds=1)
-    async def hue_cycle_task(self, ctx: cc.CustomContext, role_id: int, step: float = 0.01):
-        # get the role every time to get the latest color
-        role = ctx.guild.get_role(role_id)
-        role_color_hsv = colorsys.rgb_to_hsv(*[component / 255.0 for component in role.color.to_rgb()])
+        role_color_hsv = colorsys.rgb_to_hsv(*[component / 255.0 for component in roles[0].color.to_rgb()])
         # Check if the role has no initial color and give some arbitrary HSV color
         if role_color_hsv == (0, 0, 0):
             role_color_hsv = (0.5, 0.8, 0.8)
-        # increment the hue cycling to the beginning if it gets to the max value
-        new_color = ((role_color_hsv[0] + step) % 1.0, role_color_hsv[1], role_color_hsv[2])
-        await role.edit(color=discord.Color.from_hsv(*new_color))
+        self.start_effect(ctx.guild, rfx.hue_cycle(role_color_hsv, step), roles, speed)
+        await ctx.reply('Hue Cycle rave started')
+        await self.assign_roles(ctx, {member.id: roles for member in members or ctx.guild.members})
             
     @commands.hybrid_command(**get_command_attributes('crazy'))
     async def crazy(self, ctx: cc.CustomContext,
@@ -96,105 +164,111 @@ class Rave(commands.GroupCog):
         *,
         members: list[discord.Member] | None = commands.parameter(converter=MemberListConverter, **get_command_parameters('crazy', 'members'))
     ) -> None:
-        # Prepare roles
+        # Prepare roles. The effect starts while the members get them
         roles = await self.get_roles(ctx.guild, amount)
-        await self.apply_even_roles(roles, members or ctx.guild.members)
-        # Prepare tasks
-        self.crazy_task.change_interval(seconds=speed)
-        self.crazy_task.count = self.timeout // speed
-        self.crazy_task.start(roles)
+        frames = min(math.ceil(self.timeout / speed), self.max_frames)
+        self.start_effect(ctx.guild, rfx.crazy(amount, frames), roles, speed)
         await ctx.reply('Crazy rave started')
-        
-    @tasks.loop(seconds=4)
-    async def crazy_task(self, roles: list[discord.Role]):
-        for role in roles:
-            color_hsv = (random.random(), 0.8, 0.8)
-            await role.edit(color=discord.Color.from_hsv(*color_hsv))
-            
+        await self.assign_roles(ctx, self.even_roles(roles, members or ctx.guild.members))
+
+    @commands.hybrid_command(**get_command_attributes('gradient'))
+    async def gradient(self, ctx: cc.CustomContext,
+        amount: int = commands.parameter(**get_command_parameters('gradient', 'amount')),
+        step: float = commands.parameter(**get_command_parameters('gradient', 'step')),
+        speed: float = commands.parameter(**get_command_parameters('gradient', 'speed')),
+        *,
+        members: list[discord.Member] | None = commands.parameter(converter=MemberListConverter, **get_command_parameters('gradient', 'members'))
+    ) -> None:
+        roles = await self.get_roles(ctx.guild, amount)
+        self.start_effect(ctx.guild, rfx.gradient(amount, step), roles, speed)
+        await ctx.reply('Gradient rave started')
+        await self.assign_roles(ctx, self.even_roles(roles, members or ctx.guild.members))
+
+    @commands.hybrid_command(**get_command_attributes('pulse'))
+    async def pulse(self, ctx: cc.CustomContext,
+        amount: int = commands.parameter(**get_command_parameters('pulse', 'amount')),
+        period: int = commands.parameter(**get_command_parameters('pulse', 'period')),
+        speed: float = commands.parameter(**get_command_parameters('pulse', 'speed')),
+        *,
+        members: list[discord.Member] | None = commands.parameter(converter=MemberListConverter, **get_command_parameters('pulse', 'members'))
+    ) -> None:
+        roles = await self.get_roles(ctx.guild, amount)
+        self.start_effect(ctx.guild, rfx.pulse(amount, period), roles, speed)
+        await ctx.reply('Pulse rave started')
+        await self.assign_roles(ctx, self.even_roles(roles, members or ctx.guild.members))
+
+    def start_effect(self, guild: discord.Guild, effect: rfx.Effect, roles: list[discord.Role], speed: float) -> None:
+        # The colors the roles already have are not sent again
+        player = rfx.EffectPlayer(effect, [role.color.value for role in roles])
+        pacer = rl.FramePacer(speed, functools.partial(rl.role_edit_bucket, self.bot.http, guild.id))
+        # Replaces the running rave of the guild
+        self.scheduler.start(rs.RaveSession(guild.id, roles, player, pacer, self.timeout))
+
     async def create_roles(self, guild: discord.Guild, amount: int) -> list[discord.Role]:
-        # Create new roles
-        created_roles = []
-        for _ in range(amount):
-            role: discord.Role = await guild.create_role(name=self.role_name)
-            created_roles.append(role)
-
-        roles_positions = {role: idx for idx, role in enumerate(guild.roles)}
-        roles_positions = dict(reversed(list(roles_positions.items())))
-        found = False
-        for role, position in roles_positions.items():
-            if role.name == self.bot.user.name:
-                found = True
-                for idx, created_role in enumerate(created_roles, start=1):
-                    roles_positions[created_role] = position - idx
-            elif self.is_rave_role(role):
-                break
-            elif found:
-                roles_positions[role] = position - amount
-        roles_positions = dict(sorted(roles_positions.items(), key=lambda x: x[1]))
-        await guild.edit_role_positions(positions=roles_positions)
+        created_roles = [await guild.create_role(name=self.role_name) for _ in range(amount)]
+        for role in created_roles:
+            self.role_index.add(role)
+        # Move the new roles right below the highest role of the bot, with a single request
+        top_role = guild.me.top_role
+        if top_role.is_default():
+            return created_roles
+        created_ids = {role.id for role in created_roles}
+        order = [role for role in guild.roles if role.id not in created_ids]
+        top = order.index(top_role)
+        # The first created role is the highest one. Only the roles below the bot move, the ones above keep their positions
+        order[top:top] = reversed(created_roles)
+        positions = {role: position for position, role in enumerate(order[:top + amount]) if not role.is_default()}
+        await guild.edit_role_positions(positions=positions)
         return created_roles
 
     async def delete_roles(self, guild: discord.Guild, amount: int = 1, all=False) -> None:
-        deleted = 0
-        for role in guild.roles:
-            if self.is_rave_role(role) and ((deleted < amount) or (all)):
-                await role.delete()
-                deleted += 1
+        roles = self.role_index.roles(guild)
+        for role in roles if all else roles[:amount]:
+            await role.delete()
+            self.role_index.discard(role)
 
     async def get_roles(self, guild: discord.Guild, amount: int) -> list[discord.Role]:
-        existing_roles = [role for role in guild.roles if self.is_rave_role(role)]
+        existing_roles = self.role_index.roles(guild)
         if (existing_roles_amount := len(existing_roles)) < amount:
             existing_roles.extend(await self.create_roles(guild, amount-existing_roles_amount))
         return existing_roles[:amount]
 
-    async def apply_all_roles(self, roles: list[discord.Role], members: list[discord.Member]) -> None:
-        for member in members:
-            await member.add_roles(*roles)
-            
-    async def apply_even_roles(self, roles: list[discord.Role], members: list[discord.Member]) -> None:
-        roles_cycle = itertools.cycle(roles)
+    async def assign_roles(self, ctx: cc.CustomContext, desired: dict[int, list[discord.Role]]) -> None:
+        # Only the members without their role (or with a rave role they should not have) are edited. Bots are left alone
+        rave_roles = self.role_index.roles(ctx.guild)
+        changes, unchanged = ra.plan_changes(ctx.guild.members, desired, rave_roles)
+        if not changes:
+            return
+        job = ra.AssignmentJob(ctx.guild.id, changes)
+        message = await ctx.reply(f'Updating the rave roles: 0/{job.total} ({unchanged} members already have theirs)')
+
+        async def report(job: ra.AssignmentJob) -> None:
+            await message.edit(content=f'Updating the rave roles: {job.processed}/{job.total} ({unchanged} members already have theirs)')
+        await self.assigner.run(job, report)
+
+    def even_roles(self, roles: list[discord.Role], members: list[discord.Member]) -> dict[int, list[discord.Role]]:
+        # Spread the members evenly between the roles. Members that already have one keep it while it has room
+        members = [member for member in members if not member.bot]
+        share = -(-len(members) // len(roles))
+        counts = collections.Counter({role.id: 0 for role in roles})
+        desired = {}
+        unassigned = []
         for member in members:
-            await member.add_roles(next(roles_cycle))
-
-    def is_rave_role(self, role: discord.Role) -> bool:
-        return role.name == self.role_name
-
-    def get_tasks(self) -> tuple[tasks.Loop]:
-        tasks_list = []
-        for attr in dir(self):
-            if attr.endswith('_task'):
-                task = getattr(self, attr)
-                if isinstance(task, tasks.Loop):
-                    tasks_list.append(task)
-        return tuple(tasks_list)
-
-    def stop_tasks(self) -> None:
-        for task in self.tasks:
-            if task.is_running():
-                task.stop()
-    
-    def cog_unload(self):
-        self.stop_tasks()
-    
-    async def on_tasks_error(self, _, error: discord.DiscordException):
-        # sourcery skip: remove-pass-body
-        # Because this function is not being set by a decorator, it receives two "self" arguments when called. Using the "_" to ignore the second "self" argument
-        # In case the role is deleted while the task is running
-        if isinstance(error, (AttributeError, discord.errors.NotFound)):
-            pass
-        else:
-            logger.exception(f'Error on a task: {error}')
-            
-    async def on_tasks_before_loop(self, _):
-        # Because this function is not being set by a decorator, it receives two "self" arguments when called. Using the "_" to ignore the second "self" argument
-        logger.debug('Task started')
-        
-    async def on_tasks_after_loop(self, _):
-        # Because this function is not being set by a decorator, it receives two "self" arguments when called. Using the "_" to ignore the second "self" argument
-        logger.debug('task stopped')
-    
-    def setup_tasks(self):
-        for task in self.tasks:
-            task.error(self.on_tasks_error)
-            task.before_loop(self.on_tasks_before_loop)
-            task.after_loop(self.on_tasks_after_loop)
\ No newline at end of file
+            held = next((role for role in member.roles if role.id in counts), None)
+            if held is not None and counts[held.id] < share:
+                desired[member.id] = [held]
+                counts[held.id] += 1
+            else:
+                unassigned.append(member)
+        for member in unassigned:
+            role = min(roles, key=lambda role: counts[role.id])
+            desired[member.id] = [role]
+            counts[role.id] += 1
+        return desired
+
+    async def cog_unload(self):
+        self.scheduler.close()
+        if self.resume_task is not None:
+            self.resume_task.cancel()
+        # The unfinished assignments are checkpointed and resumed on the next load
+        await self.assigner.close()
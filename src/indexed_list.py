@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import random
+import typing as t
+
+T = t.TypeVar('T')
+
+
+class _Node(t.Generic[T]):
+    __slots__ = ('value', 'priority', 'size', 'left', 'right', 'parent')
+
+    def __init__(self, value: T) -> None:
+        self.value = value
+        self.priority = random.random()
+        self.size = 1
+        self.left: _Node[T] | None = None
+        self.right: _Node[T] | None = None
+        self.parent: _Node[T] | None = None
+
+
+def _size(node: _Node | None) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Node) -> _Node:
+    node.size = 1 + _size(node.left) + _size(node.right)
+    if node.left is not None:
+        node.left.parent = node
+    if node.right is not None:
+        node.right.parent = node
+    return node
+
+
+def _split(node: _Node | None, count: int) -> tuple[_Node | None, _Node | None]:
+    """Split a tree in its first "count" values and the rest"""
+    if node is None:
+        return None, None
+    if _size(node.left) >= count:
+        left, node.left = _split(node.left, count)
+        if left is not None:
+            left.parent = None
+        return left, _update(node)
+    node.right, right = _split(node.right, count - _size(node.left) - 1)
+    if right is not None:
+        right.parent = None
+    return _update(node), right
+
+
+def _merge(left: _Node | None, right: _Node | None) -> _Node | None:
+    """Concatenate two trees"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+class IndexedList(t.Generic[T]):
+    """A sequence with O(log n) positional insert, delete, move and access, and O(log n + k) slices
+
+    Implemented as an implicit treap (a randomized balanced tree ordered by position).
+    Values must be hashable and unique, so the position of a value is also found in O(log n).
+
+    The shuffle is lazy: the shuffled range is only put in order (one Fisher-Yates step per position)
+    as its positions are accessed, e.g. when the first value is popped or when a page is sliced.
+    """
+
+    def __init__(self, values: t.Iterable[T] = ()) -> None:
+        self._root: _Node[T] | None = None
+        self._nodes: dict[T, _Node[T]] = {}
+        # Positions in [_settled, _shuffle_end) are still in random order
+        self._settled = 0
+        self._shuffle_end = 0
+        for value in values:
+            self.append(value)
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __bool__(self) -> bool:
+        return self._root is not None
+
+    def __contains__(self, value: object) -> bool:
+        return value in self._nodes
+
+    def __iter__(self) -> t.Iterator[T]:
+        index = 0
+        while index < len(self):
+            yield self[index]
+            index += 1
+
+    def __getitem__(self, index: int) -> T:
+        index = self._check_index(index)
+        self._settle(index + 1)
+        return self._node_at(index).value
+
+    def __delitem__(self, index: int) -> None:
+        self.pop(index)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({list(self)!r})'
+
+    def append(self, value: T) -> None:
+        self._add_node(value)
+        self._set_root(_merge(self._root, self._nodes[value]))
+
+    def insert(self, index: int, value: T) -> None:
+        index = max(0, min(index if index >= 0 else len(self) + index, len(self)))
+        self._settle(index)
+        self._add_node(value)
+        left, right = _split(self._root, index)
+        self._set_root(_merge(_merge(left, self._nodes[value]), right))
+        self._shift_shuffle(index, 1)
+
+    def pop(self, index: int = -1) -> T:
+        index = self._check_index(index)
+        self._settle(index + 1)
+        left, right = _split(self._root, index)
+        node, right = _split(right, 1)
+        self._set_root(_merge(left, right))
+        del self._nodes[node.value]
+        self._shift_shuffle(index, -1)
+        return node.value
+
+    def popleft(self) -> T:
+        return self.pop(0)
+
+    def remove(self, value: T) -> None:
+        """Remove a value. Raises ValueError if it is not in the list"""
+        index = self._rank(value)
+        if self._settled <= index < self._shuffle_end:
+            # Still in the shuffled range, whose order does not matter yet
+            left, right = _split(self._root, index)
+            node, right = _split(right, 1)
+            self._set_root(_merge(left, right))
+            del self._nodes[value]
+            self._shuffle_end -= 1
+        else:
+            self.pop(index)
+
+    def index(self, value: T) -> int:
+        """The current position of a value. Raises ValueError if it is not in the list"""
+        index = self._rank(value)
+        while self._settled <= index < self._shuffle_end:
+            # Settle up to it. It may be swapped to a later unsettled position, so check again
+            self._settle(index + 1)
+            index = self._rank(value)
+        return index
+
+    def move(self, source: int, destination: int) -> None:
+        """Move the value at "source" so it ends at "destination" """
+        self.insert(self._check_index(destination), self.pop(source))
+
+    def slice(self, start: int, stop: int) -> list[T]:
+        """The values in [start, stop)"""
+        start, stop = max(0, start), min(stop, len(self))
+        if start >= stop:
+            return []
+        self._settle(stop)
+        left, right = _split(self._root, start)
+        middle, right = _split(right, stop - start)
+        values: list[T] = []
+        self._collect(middle, values)
+        self._set_root(_merge(_merge(left, middle), right))
+        return values
+
+    def delete_range(self, start: int, stop: int) -> list[T]:
+        """Remove the values in [start, stop) and return them"""
+        start, stop = max(0, start), min(stop, len(self))
+        if start >= stop:
+            return []
+        self._settle(stop)
+        left, right = _split(self._root, start)
+        middle, right = _split(right, stop - start)
+        self._set_root(_merge(left, right))
+        values: list[T] = []
+        self._collect(middle, values)
+        for value in values:
+            del self._nodes[value]
+        self._shift_shuffle(start, start - stop)
+        return values
+
+    def shuffle(self, start: int = 0) -> None:
+        """Shuffle the values from "start" to the end. O(1): the order is only decided when the positions are accessed"""
+        start = max(0, min(start, len(self)))
+        self._settle(start)
+        self._settled = start
+        self._shuffle_end = len(self)
+
+    def clear(self) -> None:
+        self._root = None
+        self._nodes.clear()
+        self._settled = self._shuffle_end = 0
+
+    def _settle(self, stop: int) -> None:
+        """Finish the lazy Fisher-Yates shuffle for the positions before "stop" """
+        stop = min(stop, self._shuffle_end)
+        while self._settled < stop:
+            index = self._settled
+            other = random.randrange(index, self._shuffle_end)
+            if other != index:
+                first, second = self._node_at(index), self._node_at(other)
+                # Swap the values, keeping the nodes in place
+                first.value, second.value = second.value, first.value
+                self._nodes[first.value] = first
+                self._nodes[second.value] = second
+            self._settled += 1
+
+    def _shift_shuffle(self, index: int, delta: int) -> None:
+        # Values inserted or removed before the shuffled range move it
+        if index <= self._settled and self._settled < self._shuffle_end:
+            self._settled += delta
+            self._shuffle_end += delta
+        if self._settled >= self._shuffle_end:
+            self._settled = self._shuffle_end = 0
+
+    def _rank(self, value: T) -> int:
+        """The position of the node of a value, walking up from it"""
+        node = self._nodes.get(value)
+        if node is None:
+            raise ValueError(f'{value!r} is not in list')
+        index = _size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                index += _size(node.parent.left) + 1
+            node = node.parent
+        return index
+
+    def _set_root(self, node: _Node[T] | None) -> None:
+        if node is not None:
+            node.parent = None
+        self._root = node
+
+    def _add_node(self, value: T) -> None:
+        if value in self._nodes:
+            raise ValueError(f'{value!r} is already in list')
+        self._nodes[value] = _Node(value)
+
+    def _node_at(self, index: int) -> _Node[T]:
+        node = self._root
+        while True:
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+
+    def _check_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Index out of range')
+        return index
+
+    @staticmethod
+    def _collect(node: _Node[T] | None, values: list[T]) -> None:
+        # Iterative in-order traversal
+        stack: list[_Node[T]] = []
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            values.append(node.value)
+            node = node.right
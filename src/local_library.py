@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import heapq
+import json
+import logging
+import os
+import typing as t
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+import mutagen
+
+import track_index as tx
+import track_info as ti
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = frozenset({'.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma', '.aiff', '.ape', '.wv'})
+
+# The tag keys of the easy interfaces (MP3, MP4, Vorbis comments) and the ID3 frames of the formats without one (e.g. WAVE)
+TAG_KEYS = {
+    'title': ('title', 'TIT2'),
+    'artist': ('artist', 'albumartist', 'TPE1', 'TPE2'),
+    'album': ('album', 'TALB'),
+}
+
+
+class LocalTrack:
+    __slots__ = ('path', 'mtime_ns', 'size', 'title', 'artist', 'album', 'duration', 'key')
+
+    def __init__(self, path: str, mtime_ns: int, size: int, title: str, artist: str | None = None, album: str | None = None, duration: float = 0.0) -> None:
+        # Relative to the library root, with "/" separators
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.title = title
+        self.artist = artist
+        self.album = album
+        # In seconds. 0 when unknown
+        self.duration = duration
+        # The normalized text that is searched
+        self.key = tx.TrackIndex.normalize(' '.join(filter(None, (title, artist, album))))
+
+    @property
+    def display_title(self) -> str:
+        return f'{self.artist} - {self.title}' if self.artist else self.title
+
+
+class LibraryChanges(t.NamedTuple):
+    # New or modified files, with their tags already read
+    tracks: list[LocalTrack]
+    # Paths of the files that are gone
+    removed: list[str]
+    unchanged: int
+
+
+class ScanResult(t.NamedTuple):
+    added: int
+    updated: int
+    removed: int
+    unchanged: int
+
+
+class LocalLibrary:
+    """Index of the audio files of a local folder. The files are played straight by FFmpeg, without yt-dlp
+
+    Scans are incremental: a file whose modification time and size did not change is not opened again.
+    The tags and durations are persisted (gzipped JSON). Searches use the same trigram scheme as the TrackIndex.
+    """
+
+    def __init__(self, root: Path | str, path: Path | str | None = None, extensions: t.Collection[str] = AUDIO_EXTENSIONS) -> None:
+        """
+        Args:
+            root (Path | str): The folder of the audio files. Subfolders are included.
+            path (Path | str | None, optional): The file where the index is persisted. If None, it is not persisted. Defaults to None.
+            extensions (t.Collection[str], optional): The lowercase extensions of the indexed files. Defaults to AUDIO_EXTENSIONS.
+        """
+        self.root = Path(root).expanduser().resolve()
+        self.path = Path(path) if path is not None else None
+        self.extensions = frozenset(extensions)
+        self.dirty = False
+        self._tracks: dict[str, LocalTrack] = {}
+        self._grams: dict[str, set[LocalTrack]] = {}
+        self._refreshing = False
+        if self.path is not None:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def get(self, path: str) -> LocalTrack | None:
+        return self._tracks.get(path)
+
+    def match(self, search: str) -> LocalTrack | None:
+        """The track a play search names exactly: its path, its file URI, its title or its artist and title. None otherwise
+
+        Unlike "search", a partial match is not enough. A play search that only resembles a local file must still go to yt-dlp.
+        """
+        if search.startswith('file://'):
+            try:
+                search = Path(urllib.request.url2pathname(urllib.parse.urlsplit(search).path)).relative_to(self.root).as_posix()
+            except ValueError:
+                return None
+        if (track := self._tracks.get(search)) is not None:
+            return track
+        query = self._plain(search)
+        if not query:
+            return None
+        for track in self.search(query, limit=5):
+            if query in {self._plain(track.title), self._plain(track.display_title), self._plain(f'{track.title} {track.artist or ""}')}:
+                return track
+        return None
+
+    def search(self, query: str, limit: int = 25) -> list[LocalTrack]:
+        """The tracks whose title, artist or album contain every word of the query. The ones that start with the query first"""
+        query = tx.TrackIndex.normalize(query)
+        if not query:
+            candidates = self._tracks.values()
+        else:
+            words = query.split()
+            grams = {gram for word in words for gram in tx.TrackIndex.grams(word)}
+            if grams:
+                postings = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                candidates = self._tracks.values()
+            candidates = [track for track in candidates if all(word in track.key for word in words)]
+        return heapq.nsmallest(limit, candidates, key=lambda track: (not track.key.startswith(query), track.key, track.path))
+
+    def track_info(self, track: LocalTrack) -> ti.TrackInfo:
+        """The TrackInfo the queue plays. Its stream url is the path of the file"""
+        file = self.root.joinpath(*track.path.split('/'))
+        return ti.TrackInfo(
+            title=track.display_title,
+            webpage_url=file.as_uri(),
+            stream_url=str(file),
+            duration=int(track.duration),
+            uploader=track.artist,
+        )
+
+    async def refresh(self) -> ScanResult | None:
+        """Scan the folder in a thread and apply the changes. None if a scan is already running"""
+        if self._refreshing:
+            return None
+        self._refreshing = True
+        try:
+            loop = asyncio.get_running_loop()
+            changes = await loop.run_in_executor(None, self.find_changes)
+            # Applied on the event loop, so searches never see a half updated index
+            result = self.apply(changes)
+            if self.dirty:
+                await loop.run_in_executor(None, self.save)
+        finally:
+            self._refreshing = False
+        logger.info(f'Scanned the local library: {result.added} added, {result.updated} updated, {result.removed} removed, {result.unchanged} unchanged')
+        return result
+
+    def scan(self) -> ScanResult:
+        """Scan the folder and apply the changes, blocking"""
+        return self.apply(self.find_changes())
+
+    def find_changes(self) -> LibraryChanges:
+        """Walk the folder and read the tags of the new and modified files. Does not modify the index"""
+        tracks = []
+        seen = set()
+        unchanged = 0
+        for file, relative, stat in self._walk(self.root):
+            seen.add(relative)
+            known = self._tracks.get(relative)
+            if known is not None and known.mtime_ns == stat.st_mtime_ns and known.size == stat.st_size:
+                unchanged += 1
+                continue
+            tracks.append(self.read_track(file, relative, stat))
+        removed = [relative for relative in self._tracks if relative not in seen]
+        return LibraryChanges(tracks, removed, unchanged)
+
+    def apply(self, changes: LibraryChanges) -> ScanResult:
+        added = updated = 0
+        for track in changes.tracks:
+            known = self._tracks.get(track.path)
+            if known is not None:
+                self._unindex(known)
+                updated += 1
+            else:
+                added += 1
+            self._index(track)
+        for relative in changes.removed:
+            if (known := self._tracks.get(relative)) is not None:
+                self._unindex(known)
+        if changes.tracks or changes.removed:
+            self.dirty = True
+        return ScanResult(added, updated, len(changes.removed), changes.unchanged)
+
+    @staticmethod
+    def read_track(file: str, relative: str, stat: os.stat_result) -> LocalTrack:
+        """Read the tags and the duration of a file. Unreadable files are kept with the file name as title, so they are not read again"""
+        title = os.path.splitext(os.path.basename(relative))[0]
+        try:
+            audio = mutagen.File(file, easy=True)
+        except Exception as error:
+            logger.info(f'Failed to read the tags of "{file}": {error}')
+            audio = None
+        if audio is None:
+            return LocalTrack(relative, stat.st_mtime_ns, stat.st_size, title)
+
+        tags = audio.tags or {}
+
+        def first(name: str) -> str | None:
+            for key in TAG_KEYS[name]:
+                value = tags.get(key)
+                # A list on the easy interfaces, a frame with a "text" list on ID3
+                values = getattr(value, 'text', value)
+                if values:
+                    text = str(values[0]).strip()
+                    if text:
+                        return text
+            return None
+
+        duration = getattr(audio.info, 'length', 0) or 0
+        return LocalTrack(relative, stat.st_mtime_ns, stat.st_size, first('title') or title, first('artist'), first('album'), round(duration, 2))
+
+    def load(self) -> None:
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logger.warning(f'Failed to load the local library index from "{self.path}": {error}')
+            return
+        # The relative paths are meaningless for another folder
+        if data.get('root') != str(self.root):
+            logger.info(f'The local library index at "{self.path}" belongs to another folder. It will be rebuilt')
+            return
+        for row in data['tracks']:
+            self._index(LocalTrack(*row))
+        logger.info(f'Loaded {len(self._tracks)} tracks into the local library')
+
+    def save(self) -> None:
+        """Write the index to its file, if it changed. The file is replaced atomically"""
+        if self.path is None or not self.dirty:
+            return
+        rows = [
+            [track.path, track.mtime_ns, track.size, track.title, track.artist, track.album, track.duration]
+            for track in list(self._tracks.values())
+        ]
+        temporary = self.path.with_suffix('.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(temporary, 'wt', encoding='utf-8') as file:
+                json.dump({'root': str(self.root), 'tracks': rows}, file, separators=(',', ':'), ensure_ascii=False)
+            os.replace(temporary, self.path)
+        except OSError as error:
+            logger.warning(f'Failed to save the local library index to "{self.path}": {error}')
+            return
+        self.dirty = False
+
+    def _walk(self, folder: Path | str, prefix: str = '') -> t.Iterator[tuple[str, str, os.stat_result]]:
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as error:
+            logger.warning(f'Failed to list the local library folder "{folder}": {error}')
+            return
+        for entry in entries:
+            relative = f'{prefix}{entry.name}'
+            try:
+                if entry.is_dir():
+                    yield from self._walk(entry.path, f'{relative}/')
+                elif os.path.splitext(entry.name)[1].lower() in self.extensions:
+                    yield entry.path, relative, entry.stat()
+            except OSError as error:
+                logger.info(f'Failed to read "{entry.path}": {error}')
+
+    @staticmethod
+    def _plain(text: str) -> str:
+        # Normalized and without the separator of "artist - title"
+        return ' '.join(word for word in tx.TrackIndex.normalize(text).split() if word != '-')
+
+    def _index(self, track: LocalTrack) -> None:
+        self._tracks[track.path] = track
+        for gram in tx.TrackIndex.grams(track.key):
+            self._grams.setdefault(gram, set()).add(track)
+
+    def _unindex(self, track: LocalTrack) -> None:
+        del self._tracks[track.path]
+        for gram in tx.TrackIndex.grams(track.key):
+            posting = self._grams.get(gram)
+            if posting is not None:
+                posting.discard(track)
+                if not posting:
+                    del self._grams[gram]
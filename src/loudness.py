@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import re
+import shlex
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+# The summary the ebur128 filter prints at the end, e.g. "I:         -9.3 LUFS"
+INTEGRATED_LOUDNESS = re.compile(rb'I:\s+(-?\d+(?:\.\d+)?) LUFS')
+
+
+class LoudnessAnalyzer:
+    """Measure the integrated loudness of tracks with FFmpeg, in the background and with bounded concurrency
+
+    Each track is measured once. The resulting gain is meant to be stored and applied as a plain volume multiplier,
+    so no loudness filter runs while the track is played.
+    """
+
+    def __init__(self, target: float = -14.0,
+            max_gain_db: float = 12.0,
+            max_concurrency: int = 2,
+            max_seconds: float = 0,
+            timeout: float = 120,
+            executable: str = 'ffmpeg',
+            before_options: str = '',
+    ) -> None:
+        """
+        Args:
+            target (float, optional): The loudness (LUFS) every track is brought to. Defaults to -14.0.
+            max_gain_db (float, optional): Maximum boost or cut in dB. Defaults to 12.0.
+            max_concurrency (int, optional): Maximum amount of FFmpeg measurements at the same time. Defaults to 2.
+            max_seconds (float, optional): Only measure the first seconds of each track. 0 to measure it whole. Defaults to 0.
+            timeout (float, optional): Maximum seconds a measurement can take. Defaults to 120.
+            executable (str, optional): The FFmpeg executable. Defaults to 'ffmpeg'.
+            before_options (str, optional): FFmpeg options placed before the input (e.g. reconnect options). Defaults to ''.
+        """
+        self.target = target
+        self.max_gain_db = max_gain_db
+        self.max_seconds = max_seconds
+        self.timeout = timeout
+        self.executable = executable
+        self.before_options = before_options
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight: dict[t.Hashable, asyncio.Task[float | None]] = {}
+        # The callbacks waiting for each measurement in flight
+        self._callbacks: dict[t.Hashable, list[t.Callable[[float], None]]] = {}
+
+    def schedule(self, key: t.Hashable, url: str, callback: t.Callable[[float], None]) -> None:
+        """Measure a track in the background and call "callback" with its gain. Concurrent requests of a key share one measurement"""
+        if key not in self._in_flight:
+            task = self._in_flight[key] = asyncio.create_task(self.gain(url))
+            callbacks = self._callbacks[key] = []
+            task.add_done_callback(functools.partial(self._done, key, callbacks))
+        self._callbacks[key].append(callback)
+
+    def cancel(self, key: t.Hashable, callback: t.Callable[[float], None]) -> None:
+        """Withdraw a callback. The measurement is cancelled (and its FFmpeg process killed) when no callback waits for it anymore"""
+        callbacks = self._callbacks.get(key)
+        if callbacks is None or callback not in callbacks:
+            return
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._callbacks[key]
+            self._in_flight.pop(key).cancel()
+
+    def _done(self, key: t.Hashable, callbacks: list[t.Callable[[float], None]], task: asyncio.Task[float | None]) -> None:
+        # A cancelled measurement may already have been replaced by a new one of the same key
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+            del self._callbacks[key]
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        for callback in callbacks:
+            callback(task.result())
+
+    async def gain(self, url: str) -> float | None:
+        """The linear gain that brings a track to the target loudness. None if it could not be measured"""
+        loudness = await self.measure(url)
+        if loudness is None:
+            return None
+        gain_db = max(-self.max_gain_db, min(self.target - loudness, self.max_gain_db))
+        return round(10 ** (gain_db / 20), 4)
+
+    async def measure(self, url: str) -> float | None:
+        """The integrated loudness (LUFS) of a track. None if it could not be measured"""
+        # The before options (e.g. reconnect options) only apply to network streams
+        before_options = shlex.split(self.before_options) if '://' in url else []
+        args = [self.executable, '-hide_banner', '-nostats', *before_options, '-i', url, '-vn', '-sn', '-dn']
+        if self.max_seconds:
+            args += ['-t', str(self.max_seconds)]
+        # The per-frame values go to the verbose log level. Only the summary is printed
+        args += ['-af', 'ebur128=framelog=verbose', '-f', 'null', '-']
+
+        async with self._semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as error:
+                logger.warning(f'Failed to start FFmpeg to measure the loudness: {error}')
+                return None
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.info(f'Timed out measuring the loudness of "{url}"')
+                return None
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+
+        # The last match is the summary. The previous ones (if any) are momentary values
+        matches = INTEGRATED_LOUDNESS.findall(stderr)
+        if process.returncode != 0 or not matches:
+            logger.info(f'Could not measure the loudness of "{url}" (FFmpeg exited with {process.returncode})')
+            return None
+        loudness = float(matches[-1])
+        # Silence measures as -70 LUFS. Do not boost it
+        return loudness if loudness > -70 else None
+
+    async def close(self) -> None:
+        """Cancel the measurements in progress. Their FFmpeg processes are killed"""
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import typing as t
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# Sends or edits the now playing message. Gets the previous message (if any) and returns the current one
+NotifyCallback = t.Callable[[t.Optional[discord.Message]], t.Awaitable[t.Optional[discord.Message]]]
+
+
+class NowPlayingDispatcher:
+    """Send the now playing notifications of a voice client in the background, so Discord latency never blocks the player
+
+    Notifications are coalesced: while one is being sent or waiting for the minimum interval, newer ones replace it.
+    The callback renders the state at the moment it runs, so only the newest track is ever shown.
+    """
+
+    def __init__(self, callback: NotifyCallback, min_interval: float = 2.0) -> None:
+        """
+        Args:
+            callback (NotifyCallback): Sends or edits the now playing message.
+            min_interval (float, optional): Minimum seconds between two notifications. Defaults to 2.0.
+        """
+        self.callback = callback
+        self.min_interval = min_interval
+        # The last now playing message. The callback may edit it instead of sending a new one
+        self.message: discord.Message | None = None
+        self.coalesced = 0
+        self._pending = False
+        self._last_sent = float('-inf')
+        self._task: asyncio.Task | None = None
+
+    def notify(self) -> None:
+        """Request a notification. Never waits"""
+        if self._pending:
+            self.coalesced += 1
+        self._pending = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def close(self) -> None:
+        self._pending = False
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            delay = self._last_sent + self.min_interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._pending = False
+            try:
+                self.message = await self.callback(self.message)
+            except discord.HTTPException as error:
+                logger.warning(f'Failed to send the now playing notification: {error}')
+            except Exception:
+                logger.exception('Failed to send the now playing notification')
+            self._last_sent = loop.time()
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import math
+import typing as t
+
+import numpy as np
+
+# 20ms of 48KHz 16-bit stereo PCM (same as discord.opus.Encoder.FRAME_SIZE)
+FRAME_SIZE = 3840
+FRAME_SAMPLES = FRAME_SIZE // 2
+FRAME_LENGTH = 0.02
+CHANNELS = 2
+
+
+class PCMFrameProcessor:
+    """Read PCM frames in blocks and apply the volume to them with NumPy
+
+    The frames are read into a reusable buffer and processed in place through an int16 view of it.
+    Volume changes are ramped smoothly (no clicks) and the track can fade in and out at its boundaries.
+    """
+
+    def __init__(self, original: t.Any,
+            volume: float = 1.0,
+            *,
+            block_frames: int = 10,
+            ramp: float = 0.1,
+            fade_in: float = 0.0,
+            fade_out: float = 0.0,
+            total_frames: int | None = None,
+    ) -> None:
+        """
+        Args:
+            original (t.Any): The PCM source. Either an FFmpegPCMAudio (its stdout is read directly) or any object with a "read" method returning frames.
+            volume (float, optional): The initial volume. Defaults to 1.0.
+            block_frames (int, optional): Amount of frames read and processed at once. Defaults to 10.
+            ramp (float, optional): Seconds a volume change takes to go from 0 to 1. Defaults to 0.1.
+            fade_in (float, optional): Seconds of fade in at the beginning of the track. Defaults to 0.0.
+            fade_out (float, optional): Seconds of fade out at the end of the track. Needs "total_frames". Defaults to 0.0.
+            total_frames (int | None, optional): The length of the track in frames. Defaults to None.
+        """
+        self.original = original
+        self.volume = volume
+        self.block_frames = block_frames
+        self.fade_in_frames = int(fade_in / FRAME_LENGTH)
+        self.fade_out_frames = int(fade_out / FRAME_LENGTH) if total_frames else 0
+        self.total_frames = total_frames
+        # Maximum gain change per stereo sample
+        self._ramp_step = 1 / (ramp * 48000) if ramp > 0 else None
+        self._gain = volume
+        # Frames read from the original so far
+        self.frames = 0
+
+        pairs = block_frames * FRAME_SAMPLES // CHANNELS
+        self._buffer = bytearray(block_frames * FRAME_SIZE)
+        self._view = memoryview(self._buffer)
+        self._samples = np.frombuffer(self._buffer, dtype=np.int16).reshape(pairs, CHANNELS)
+        self._scratch = np.empty((pairs, CHANNELS), dtype=np.float32)
+        self._gains = np.empty((pairs, 1), dtype=np.float32)
+        self._envelope = np.empty((pairs, 1), dtype=np.float32)
+        # 0, 1, 2, ... (one per stereo sample). Used to build the ramps without allocating
+        self._indexes = np.arange(pairs, dtype=np.float32).reshape(pairs, 1)
+        self._filled = 0
+        self._cursor = 0
+        self._readinto = self._get_readinto(original)
+
+    def read(self) -> bytes:
+        """Get the next processed frame. Empty bytes at the end of the stream"""
+        if self._cursor >= self._filled:
+            self._fill()
+            if not self._filled:
+                return b''
+        frame = self._view[self._cursor:self._cursor + FRAME_SIZE]
+        self._cursor += FRAME_SIZE
+        # The voice encoder needs bytes
+        return bytes(frame)
+
+    def _fill(self) -> None:
+        size = self._readinto(self._view)
+        frames = size // FRAME_SIZE
+        self._filled = frames * FRAME_SIZE
+        self._cursor = 0
+        if frames:
+            self._process(frames)
+            self.frames += frames
+
+    def _process(self, frames: int) -> None:
+        pairs = frames * FRAME_SAMPLES // CHANNELS
+        samples = self._samples[:pairs]
+        gains = self._gains[:pairs]
+
+        if self._ramp_step is None:
+            self._gain = self.volume
+        enveloped = self._build_envelope(pairs)
+        if self._gain == self.volume and not enveloped:
+            if self._gain == 1.0:
+                return
+            np.multiply(samples, self._gain, out=self._scratch[:pairs], casting='unsafe')
+        else:
+            delta = self.volume - self._gain
+            if delta:
+                # Linear ramp from the current gain towards the volume, limited to the ramp speed
+                np.multiply(self._indexes[:pairs], math.copysign(self._ramp_step, delta), out=gains)
+                if delta > 0:
+                    np.minimum(gains, delta, out=gains)
+                else:
+                    np.maximum(gains, delta, out=gains)
+                gains += self._gain
+                self._gain = float(gains[-1, 0])
+                if abs(self.volume - self._gain) < 1e-4:
+                    self._gain = self.volume
+            else:
+                gains.fill(self._gain)
+            if enveloped:
+                gains *= self._envelope[:pairs]
+            np.multiply(samples, gains, out=self._scratch[:pairs], casting='unsafe')
+
+        np.clip(self._scratch[:pairs], -32768, 32767, out=self._scratch[:pairs])
+        np.copyto(samples, self._scratch[:pairs], casting='unsafe')
+
+    def _build_envelope(self, pairs: int) -> bool:
+        """Build the fade in and fade out multipliers of the block. Returns False when there is no fade on the block"""
+        pairs_per_frame = FRAME_SAMPLES // CHANNELS
+        start = self.frames * pairs_per_frame
+        envelope = self._envelope[:pairs]
+        enveloped = False
+
+        fade_in = self.fade_in_frames * pairs_per_frame
+        if start < fade_in:
+            np.add(self._indexes[:pairs], start, out=envelope)
+            envelope /= fade_in
+            np.minimum(envelope, 1.0, out=envelope)
+            enveloped = True
+
+        if self.fade_out_frames:
+            fade_out = self.fade_out_frames * pairs_per_frame
+            fade_out_start = self.total_frames * pairs_per_frame - fade_out
+            if start + pairs > fade_out_start:
+                # Remaining samples until the end of the track, over the fade length
+                fade = self._scratch[:pairs, :1]
+                np.subtract(fade_out_start + fade_out - start, self._indexes[:pairs], out=fade)
+                fade /= fade_out
+                np.clip(fade, 0.0, 1.0, out=fade)
+                if enveloped:
+                    envelope *= fade
+                else:
+                    envelope[:] = fade
+                enveloped = True
+        return enveloped
+
+    @staticmethod
+    def _get_readinto(original: t.Any) -> t.Callable[[memoryview], int]:
+        stdout = getattr(original, '_stdout', None)
+        if stdout is not None and hasattr(stdout, 'readinto'):
+            # Read the whole block straight from the FFmpeg pipe, without intermediate bytes objects
+            return stdout.readinto
+
+        def readinto(view: memoryview) -> int:
+            size = 0
+            while size < len(view):
+                frame = original.read()
+                if not frame:
+                    break
+                view[size:size + len(frame)] = frame
+                size += len(frame)
+            return size
+        return readinto
+
+
+def mix(first: bytes, second: bytes) -> bytes:
+    """Mix two PCM frames"""
+    mixed = np.frombuffer(first, dtype=np.int16).astype(np.int32)
+    mixed[:len(second) // 2] += np.frombuffer(second, dtype=np.int16)[:len(mixed)]
+    np.clip(mixed, -32768, 32767, out=mixed)
+    return mixed.astype(np.int16).tobytes()
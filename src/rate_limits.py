@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import typing as t
+
+import discord
+
+
+class BucketState(t.NamedTuple):
+    limit: int
+    # Requests left in the current window
+    remaining: int
+    # Seconds until the window resets. 0 when it already did
+    reset_after: float
+
+
+def route_bucket(http: discord.http.HTTPClient, route: discord.http.Route) -> BucketState | None:
+    """The rate limit bucket that discord.py tracks for a route. None if it is not known yet
+
+    discord.py does not expose its buckets. They are read from private attributes of the HTTPClient,
+    so any change of them makes this return None and the callers fall back to their own pacing.
+    """
+    try:
+        buckets = http._buckets
+        route_key = route.key
+        major_parameters = route.major_parameters
+        bucket_hash = http._bucket_hashes.get(route_key)
+        # discord.py keys the buckets both with and without a colon after the hash Discord sends
+        keys = (f'{bucket_hash}:{major_parameters}', f'{bucket_hash}{major_parameters}') if bucket_hash else (f'{route_key}:{major_parameters}',)
+        ratelimit = next((buckets[key] for key in keys if key in buckets), None)
+        if ratelimit is None:
+            return None
+        limit = int(ratelimit.limit)
+        expires = ratelimit.expires
+        now = asyncio.get_running_loop().time()
+        if expires is None or expires <= now:
+            # The window is over. discord.py refills it on the next request
+            return BucketState(limit, limit - int(ratelimit.outgoing), 0.0)
+        return BucketState(limit, int(ratelimit.remaining), expires - now)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def role_edit_bucket(http: discord.http.HTTPClient, guild_id: int) -> BucketState | None:
+    """The bucket of the role edits of a guild. Every role of the guild shares it"""
+    # The role id is not a major parameter. Any id gives the same bucket
+    return route_bucket(http, discord.http.Route('PATCH', '/guilds/{guild_id}/roles/{role_id}', guild_id=guild_id, role_id=0))
+
+
+class FramePacer:
+    """Pace the frames of an animation that is sent through a rate limited route
+
+    Frames are numbered by the wall clock (one every "interval" seconds since the start), so a late animation jumps to the current frame
+    and drops the stale ones instead of queueing them. Between frames, it waits for the requested interval or, if the bucket has less budget,
+    for the time that spreads the remaining requests of the window until it resets. Some requests ("reserve") are always left to the other users of the bucket.
+    """
+
+    def __init__(self, interval: float, bucket: t.Callable[[], BucketState | None] = lambda: None, reserve: int = 1) -> None:
+        """
+        Args:
+            interval (float): The requested seconds between frames.
+            bucket (t.Callable[[], BucketState | None], optional): Gets the state of the bucket the frames are sent through. Defaults to an unknown bucket.
+            reserve (int, optional): Requests of each window that are never used. Defaults to 1.
+        """
+        self.interval = interval
+        self.bucket = bucket
+        self.reserve = reserve
+        self.sent = 0
+        self.dropped = 0
+        self._frame = -1
+        self._started: float | None = None
+        self._paused_at: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the first frame, without the paused time"""
+        if self._started is None:
+            return 0.0
+        return (self._paused_at or asyncio.get_running_loop().time()) - self._started
+
+    def pause(self) -> None:
+        if self._paused_at is None:
+            self._paused_at = asyncio.get_running_loop().time()
+
+    def resume(self) -> None:
+        """Continue from the frame it was paused on. The paused time does not count as dropped frames"""
+        if self._paused_at is not None and self._started is not None:
+            self._started += asyncio.get_running_loop().time() - self._paused_at
+        self._paused_at = None
+
+    @property
+    def requested_fps(self) -> float:
+        return 1 / self.interval
+
+    @property
+    def achieved_fps(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def next_frame(self) -> int:
+        """The frame to send now. The frames that were due since the last one are dropped"""
+        if self._started is None:
+            self._started = asyncio.get_running_loop().time()
+        frame = max(self._frame + 1, int(self.elapsed / self.interval))
+        self.dropped += frame - self._frame - 1
+        self.sent += 1
+        self._frame = frame
+        return frame
+
+    def delay(self, requests: int = 1) -> float:
+        """Seconds to wait before the next frame, which takes "requests" requests"""
+        due = 0.0
+        if self._started is not None:
+            due = max(0.0, self._started + (self._frame + 1) * self.interval - asyncio.get_running_loop().time())
+        state = self.bucket()
+        if state is None or not state.reset_after:
+            return due
+        usable = state.remaining - self.reserve
+        if usable < requests:
+            return max(due, state.reset_after)
+        return max(due, state.reset_after * requests / usable)
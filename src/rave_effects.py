@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import colorsys
+import fractions
+import math
+import random
+import typing as t
+from array import array
+
+# Color of a role that was never sent. No 24 bit color equals it
+UNKNOWN_COLOR = -1
+
+
+def rgb24(hue: float, saturation: float, value: float) -> int:
+    """The 24 bit color Discord stores for an HSV color"""
+    red, green, blue = colorsys.hsv_to_rgb(hue % 1.0, saturation, value)
+    return (round(red * 255) << 16) | (round(green * 255) << 8) | round(blue * 255)
+
+
+class Effect:
+    """A precomputed color timeline: the 24 bit color of every role on every frame, in a flat array
+
+    Computed once when the rave starts, so the frames only index the array.
+    """
+
+    __slots__ = ('name', 'roles', 'frames', 'colors', 'loop')
+
+    def __init__(self, name: str, roles: int, colors: t.Iterable[int], loop: bool = True) -> None:
+        """
+        Args:
+            name (str): The name of the effect, for the status.
+            roles (int): The amount of roles the effect colors.
+            colors (t.Iterable[int]): The colors of frame 0 for every role, then the ones of frame 1 and so on.
+            loop (bool, optional): Whether the timeline starts again after its last frame. If not, the last frame is kept. Defaults to True.
+        """
+        self.name = name
+        self.roles = roles
+        self.colors = array('i', colors)
+        self.frames = len(self.colors) // roles
+        self.loop = loop
+        if not self.frames or len(self.colors) % roles:
+            raise ValueError('The colors must be whole frames of every role')
+
+    def color(self, frame: int, role: int) -> int:
+        frame = frame % self.frames if self.loop else min(frame, self.frames - 1)
+        return self.colors[frame * self.roles + role]
+
+    @classmethod
+    def from_function(cls, name: str, roles: int, frames: int, function: t.Callable[[int, int], int], loop: bool = True) -> Effect:
+        """Precompute an effect from the color of each frame and role"""
+        return cls(name, roles, (function(frame, role) for frame in range(frames) for role in range(roles)), loop)
+
+
+def cycle_frames(step: float, max_frames: int = 4096) -> int:
+    """Frames after which a hue moving "step" per frame is back where it started, after a whole number of turns around the color wheel
+
+    e.g. a step of 0.3 takes 10 frames (3 turns). Steps that are not a fraction with at most "max_frames" as denominator are approximated.
+    """
+    return fractions.Fraction(abs(step)).limit_denominator(max_frames).denominator if step else 1
+
+
+def hue_cycle(start_hsv: tuple[float, float, float], step: float) -> Effect:
+    """One role cycling through the hues from a starting color"""
+    hue, saturation, value = start_hsv
+    return Effect.from_function('hue cycle', 1, cycle_frames(step), lambda frame, _: rgb24(hue + step * (frame + 1), saturation, value))
+
+
+def crazy(roles: int, frames: int, saturation: float = 0.8, value: float = 0.8, rng: random.Random | None = None) -> Effect:
+    """Every role jumps to a random hue on every frame"""
+    rng = rng or random.Random()
+    return Effect.from_function('crazy', roles, frames, lambda *_: rgb24(rng.random(), saturation, value))
+
+
+def gradient(roles: int, step: float, saturation: float = 0.8, value: float = 0.8) -> Effect:
+    """The roles spread evenly over the color wheel, cycling together"""
+    return Effect.from_function(
+        'gradient', roles, cycle_frames(step),
+        lambda frame, role: rgb24(role / roles + step * (frame + 1), saturation, value),
+    )
+
+
+def pulse(roles: int, period: int, saturation: float = 0.8, min_value: float = 0.2, max_value: float = 1.0) -> Effect:
+    """The roles (spread over the color wheel) fade in and out every "period" frames"""
+    period = max(2, period)
+
+    def color(frame: int, role: int) -> int:
+        brightness = (1 - math.cos(2 * math.pi * frame / period)) / 2
+        return rgb24(role / roles, saturation, min_value + (max_value - min_value) * brightness)
+    return Effect.from_function('pulse', roles, period, color)
+
+
+class EffectPlayer:
+    """Plays an Effect on some roles, only sending the colors that differ from the last ones sent"""
+
+    def __init__(self, effect: Effect, current: t.Sequence[int] | None = None) -> None:
+        """
+        Args:
+            effect (Effect): The effect to play.
+            current (t.Sequence[int] | None, optional): The colors the roles already have. Defaults to unknown colors.
+        """
+        self.effect = effect
+        self.last = array('i', current if current is not None else [UNKNOWN_COLOR] * effect.roles)
+        self.sent = 0
+        self.suppressed = 0
+
+    def changes(self, frame: int) -> list[tuple[int, int]]:
+        """The roles (by index) whose color changes on a frame, with their new color"""
+        return [
+            (role, color)
+            for role in range(self.effect.roles)
+            if (color := self.effect.color(frame, role)) != self.last[role]
+        ]
+
+    def take(self, frame: int) -> list[tuple[int, int]]:
+        """The changes of the frame to send. The roles that keep their color are counted as suppressed edits"""
+        changes = self.changes(frame)
+        self.suppressed += self.effect.roles - len(changes)
+        return changes
+
+    def mark_sent(self, role: int, color: int) -> None:
+        self.last[role] = color
+        self.sent += 1
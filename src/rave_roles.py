@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import typing as t
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class RaveRoleIndex:
+    """The ids of the rave roles of every guild, so they are not searched by name among all the roles
+
+    A guild is indexed the first time it is used. From then on, the role events keep it in sync.
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        Args:
+            name (str): The name of the rave roles.
+        """
+        self.name = name
+        self._guilds: dict[int, set[int]] = {}
+
+    def is_rave_role(self, role: discord.Role) -> bool:
+        return role.name == self.name
+
+    def ids(self, guild: discord.Guild) -> set[int]:
+        if (ids := self._guilds.get(guild.id)) is None:
+            ids = self._guilds[guild.id] = {role.id for role in guild.roles if self.is_rave_role(role)}
+        return ids
+
+    def roles(self, guild: discord.Guild) -> list[discord.Role]:
+        """The rave roles of a guild, from the lowest to the highest"""
+        roles = [role for role_id in self.ids(guild) if (role := guild.get_role(role_id)) is not None]
+        return sorted(roles, key=lambda role: role.position)
+
+    def add(self, role: discord.Role) -> None:
+        # Guilds that are not indexed yet find the role when they are
+        if role.guild.id in self._guilds and self.is_rave_role(role):
+            self._guilds[role.guild.id].add(role.id)
+
+    def discard(self, role: discord.Role) -> None:
+        if (ids := self._guilds.get(role.guild.id)) is not None:
+            ids.discard(role.id)
+
+    def update(self, role: discord.Role) -> None:
+        """Index or drop a role whose name may have changed"""
+        if self.is_rave_role(role):
+            self.add(role)
+        else:
+            self.discard(role)
+
+    def forget(self, guild_id: int) -> None:
+        self._guilds.pop(guild_id, None)
+
+
+class ReconcileResult(t.NamedTuple):
+    deleted: int
+    failed: int
+    # Orphans left for the next reconciliation, as the budget ran out
+    pending: int
+
+
+async def delete_orphans(
+    guilds: t.Iterable[discord.Guild],
+    index: RaveRoleIndex,
+    keep: t.Callable[[discord.Guild], t.Collection[int]] = lambda _: (),
+    concurrency: int = 4,
+    budget: float = 60.0,
+) -> ReconcileResult:
+    """Delete the rave roles left behind by interrupted raves
+
+    Guilds are reconciled concurrently. The roles of a guild are deleted one by one, as they share its rate limit.
+    The orphans leave the index before the first deletion, so a rave started meanwhile does not pick a role that is about to be deleted.
+    The ones that could not be deleted go back to it.
+
+    Args:
+        guilds (t.Iterable[discord.Guild]): The guilds to reconcile.
+        index (RaveRoleIndex): The rave roles of the guilds.
+        keep (t.Callable[[discord.Guild], t.Collection[int]], optional): The ids of the rave roles of a guild that are still in use. Defaults to none.
+        concurrency (int, optional): Maximum guilds reconciled at the same time. Defaults to 4.
+        budget (float, optional): Seconds the reconciliation may take. The orphans it did not reach are left for the next one. Defaults to 60.0.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    deleted = failed = 0
+    orphans: dict[int, list[discord.Role]] = {}
+    for guild in guilds:
+        kept = keep(guild)
+        orphans[guild.id] = [role for role in index.roles(guild) if role.id not in kept]
+        for role in orphans[guild.id]:
+            index.discard(role)
+
+    async def reconcile(roles: list[discord.Role]) -> None:
+        nonlocal deleted, failed
+        async with semaphore:
+            while roles:
+                role = roles[-1]
+                try:
+                    await role.delete(reason='Orphaned rave role')
+                except discord.NotFound:
+                    pass
+                except discord.HTTPException as error:
+                    logger.info(f'Failed to delete the orphaned rave role {role.id} of the guild {role.guild.id}: {error}')
+                    failed += 1
+                    index.add(role)
+                else:
+                    deleted += 1
+                roles.pop()
+
+    tasks = [asyncio.create_task(reconcile(roles)) for roles in orphans.values() if roles]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=budget)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    # Left for the next reconciliation. Until then, raves can use them
+    for roles in orphans.values():
+        for role in roles:
+            index.add(role)
+    return ReconcileResult(deleted, failed, sum(len(roles) for roles in orphans.values()))
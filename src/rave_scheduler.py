@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+
+import discord
+
+import rate_limits as rl
+import rave_effects as rfx
+
+logger = logging.getLogger(__name__)
+
+
+class RaveSession:
+    """The rave of a guild: its roles, its effect and its pacing"""
+
+    def __init__(self, guild_id: int, roles: list[discord.Role], player: rfx.EffectPlayer, pacer: rl.FramePacer, timeout: float) -> None:
+        """
+        Args:
+            guild_id (int): The guild of the rave.
+            roles (list[discord.Role]): The roles the effect colors, in the order of the effect.
+            player (rfx.EffectPlayer): Plays the effect on the roles.
+            pacer (rl.FramePacer): Paces the frames to the role edits Discord allows.
+            timeout (float): Seconds the rave runs (without the suspended time).
+        """
+        self.guild_id = guild_id
+        self.roles = roles
+        self.player = player
+        self.pacer = pacer
+        self.timeout = timeout
+        self.suspended = False
+        self.stopped = False
+        # Changes on every suspend and resume, so the entries scheduled before are ignored
+        self.generation = 0
+        self.frame_task: asyncio.Task | None = None
+
+    @property
+    def expired(self) -> bool:
+        return self.pacer.elapsed >= self.timeout
+
+    async def play_frame(self) -> float:
+        """Send the current frame. Returns the seconds to wait before the next one"""
+        # The frames follow the clock. When the edits fall behind, the frames in between are skipped
+        frame = self.pacer.next_frame()
+        for index, color in self.player.take(frame):
+            await self.roles[index].edit(color=discord.Color(color))
+            self.player.mark_sent(index, color)
+        # Every role of the guild shares the edits bucket. The next frame only takes the edits of the roles whose color changes
+        return self.pacer.delay(max(1, len(self.player.changes(frame + 1))))
+
+
+class RaveScheduler:
+    """Run the raves of every guild from a single task
+
+    The sessions wait in a heap ordered by the time of their next frame. The task sleeps until the earliest one is due,
+    so its cost grows with the frames that are due, not with the amount of raves.
+    The frames of each session are sent on their own task, so a slow guild does not delay the others.
+    """
+
+    def __init__(self) -> None:
+        self.sessions: dict[int, RaveSession] = {}
+        self._heap: list[tuple[float, int, RaveSession, int]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self, session: RaveSession) -> None:
+        """Start the rave of a guild. Replaces the running one, if any"""
+        self.stop(session.guild_id)
+        self.sessions[session.guild_id] = session
+        self._schedule(session, 0)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self, guild_id: int) -> RaveSession | None:
+        session = self.sessions.pop(guild_id, None)
+        if session is not None:
+            session.stopped = True
+            if session.frame_task is not None:
+                session.frame_task.cancel()
+        return session
+
+    def suspend(self, guild_id: int) -> RaveSession | None:
+        """Pause the rave of a guild. Its timeout does not run while it is suspended"""
+        session = self.sessions.get(guild_id)
+        if session is not None and not session.suspended:
+            session.suspended = True
+            session.generation += 1
+            session.pacer.pause()
+        return session
+
+    def resume(self, guild_id: int) -> RaveSession | None:
+        session = self.sessions.get(guild_id)
+        if session is not None and session.suspended:
+            session.suspended = False
+            session.generation += 1
+            session.pacer.resume()
+            # A frame still being sent schedules the next one itself
+            if session.frame_task is None or session.frame_task.done():
+                self._schedule(session, 0)
+        return session
+
+    def close(self) -> None:
+        for guild_id in list(self.sessions):
+            self.stop(guild_id)
+        if self._task is not None:
+            self._task.cancel()
+
+    def _schedule(self, session: RaveSession, delay: float) -> None:
+        due = asyncio.get_running_loop().time() + delay
+        # Wake the task up if this frame is due before the one it sleeps for
+        if not self._heap or due < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (due, next(self._counter), session, session.generation))
+
+    def _active(self, session: RaveSession) -> bool:
+        return not session.stopped and not session.suspended and self.sessions.get(session.guild_id) is session
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            due, _, session, generation = self._heap[0]
+            if (delay := due - loop.time()) > 0:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                continue
+            heapq.heappop(self._heap)
+            # Entries of stopped, suspended or replaced sessions are dropped when they come up
+            if generation != session.generation or not self._active(session):
+                continue
+            if session.expired:
+                self.stop(session.guild_id)
+                continue
+            session.frame_task = asyncio.create_task(self._play(session))
+
+    async def _play(self, session: RaveSession) -> None:
+        try:
+            delay = await session.play_frame()
+        except (AttributeError, discord.NotFound):
+            # A role was deleted while the rave was running
+            if self.sessions.get(session.guild_id) is session:
+                self.stop(session.guild_id)
+            return
+        except discord.HTTPException as error:
+            logger.warning(f'Failed to send a rave frame on the guild {session.guild_id}: {error}')
+            delay = session.pacer.interval
+        except Exception:
+            logger.exception(f'Error on the rave of the guild {session.guild_id}')
+            if self.sessions.get(session.guild_id) is session:
+                self.stop(session.guild_id)
+            return
+        if self._active(session):
+            self._schedule(session, delay)
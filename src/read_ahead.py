@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import array
+import logging
+import threading
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+FRAME_LENGTH = 0.02
+# 20ms of 48KHz 16-bit stereo PCM (discord.opus.Encoder.FRAME_SIZE)
+PCM_FRAME_SIZE = 3840
+PCM_SILENCE = bytes(PCM_FRAME_SIZE)
+# Largest possible Opus packet
+OPUS_MAX_PACKET_SIZE = 1275 * 3
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+
+class ReadAheadBuffer(discord.AudioSource):
+    """Read ahead of the voice send loop, so hiccups on the FFmpeg pipe or on the network are not heard
+
+    A thread reads frames from the original source into a preallocated ring buffer some seconds deep.
+    When the ring is empty (an underrun), a silence frame is sent instead of ending the track.
+    """
+
+    def __init__(self, original: discord.AudioSource, seconds: float = 2.0, prebuffer: float = 0.5, start_timeout: float = 10) -> None:
+        """
+        Args:
+            original (discord.AudioSource): The source to read ahead
+            seconds (float, optional): How deep the buffer is. Defaults to 2.0.
+            prebuffer (float, optional): Seconds buffered before the first frame is returned. Defaults to 0.5.
+            start_timeout (float, optional): Maximum seconds to wait for the prebuffer. Defaults to 10.
+        """
+        self.original = original
+        self.capacity = max(1, int(seconds / FRAME_LENGTH))
+        self.prebuffer = min(self.capacity, max(1, int(prebuffer / FRAME_LENGTH)))
+        self.start_timeout = start_timeout
+        self.underruns = 0
+        # Silence frames sent in place of the frames that did not arrive in time
+        self.silent_frames = 0
+
+        self._opus = original.is_opus()
+        self._slot_size = OPUS_MAX_PACKET_SIZE if self._opus else PCM_FRAME_SIZE
+        self._silence = OPUS_SILENCE if self._opus else PCM_SILENCE
+        self._ring = bytearray(self.capacity * self._slot_size)
+        self._view = memoryview(self._ring)
+        self._sizes = array.array('H', bytes(2 * self.capacity))
+        # Absolute indexes of the next frame to write and to read
+        self._write = 0
+        self._read = 0
+        self._ended = False
+        self._closed = False
+        self._started = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._fill, daemon=True, name=f'read-ahead:{id(self):#x}')
+        self._thread.start()
+
+    @property
+    def fill(self) -> int:
+        """Amount of frames in the buffer"""
+        return self._write - self._read
+
+    @property
+    def fill_level(self) -> float:
+        """How full the buffer is. From 0 to 1"""
+        return self.fill / self.capacity
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return {'underruns': self.underruns, 'silent_frames': self.silent_frames, 'fill': self.fill, 'fill_level': self.fill_level}
+
+    def read(self) -> bytes:
+        with self._condition:
+            if not self._started:
+                # Let the buffer fill a bit before the first frame
+                self._condition.wait_for(lambda: self.fill >= self.prebuffer or self._ended or self._closed, self.start_timeout)
+                self._started = True
+            if not self.fill:
+                if self._ended or self._closed:
+                    return b''
+                self.underruns += 1
+                # Give the reader one frame worth of time before sending silence
+                if not self._condition.wait_for(lambda: self.fill or self._ended or self._closed, FRAME_LENGTH):
+                    self.silent_frames += 1
+                    return self._silence
+                if not self.fill:
+                    return b''
+
+            slot = self._read % self.capacity
+            start = slot * self._slot_size
+            frame = bytes(self._view[start:start + self._sizes[slot]])
+            self._read += 1
+            self._condition.notify_all()
+        return frame
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def cleanup(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        # Killing FFmpeg also unblocks a reader thread waiting on its pipe
+        self.original.cleanup()
+        self._thread.join(timeout=1)
+        if self.underruns:
+            logger.debug(f'Read-ahead buffer closed with {self.underruns} underruns')
+
+    def _fill(self) -> None:
+        # Runs on the read-ahead thread
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self.fill < self.capacity or self._closed)
+                    if self._closed:
+                        return
+                frame = self.original.read()
+                with self._condition:
+                    if not frame or self._closed:
+                        self._ended = True
+                        self._condition.notify_all()
+                        return
+                    slot = self._write % self.capacity
+                    start = slot * self._slot_size
+                    size = min(len(frame), self._slot_size)
+                    self._view[start:start + size] = frame[:size]
+                    self._sizes[slot] = size
+                    self._write += 1
+                    self._condition.notify_all()
+        except Exception:
+            # e.g. the pipe was closed by the cleanup
+            if not self._closed:
+                logger.exception('Read-ahead thread failed')
+            with self._condition:
+                self._ended = True
+                self._condition.notify_all()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import collections
+import functools
+import logging
+import typing as t
+
+import audio_cache as ac
+import audio_resolver as ar
+import custom_errors as ce
+import local_library as ll
+import track_info as ti
+
+logger = logging.getLogger(__name__)
+
+
+class TierStats:
+    """Outcome counters and recent latencies of a resolver tier"""
+
+    def __init__(self, max_samples: int = 1000) -> None:
+        self.counters = collections.Counter()
+        # Seconds of the last finished lookups. Cancelled lookups did not finish, so they have no latency
+        self.latencies: collections.deque[float] = collections.deque(maxlen=max_samples)
+
+    def record(self, outcome: str, latency: float | None = None) -> None:
+        self.counters[outcome] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def percentile(self, fraction: float) -> float | None:
+        if not self.latencies:
+            return None
+        samples = sorted(self.latencies)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    @property
+    def summary(self) -> dict[str, float | None]:
+        """The counters and the p50, p95 and p99 latencies (milliseconds)"""
+        summary: dict[str, float | None] = dict.fromkeys(('hits', 'misses', 'errors', 'cancelled'), 0)
+        summary |= self.counters
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            latency = self.percentile(fraction)
+            summary[name] = round(latency * 1000, 1) if latency is not None else None
+        return summary
+
+
+class ResolverTier(abc.ABC):
+    """A way to turn a play search into a TrackInfo. Subclasses implement "lookup"
+
+    The budget is how long the tier is waited alone. After it, the next tier is started in parallel.
+    """
+
+    name = 'tier'
+
+    def __init__(self, budget: float = 0.1) -> None:
+        self.budget = budget
+        self.stats = TierStats()
+
+    @abc.abstractmethod
+    async def lookup(self, search: str, bitrate: int | None) -> ti.TrackInfo | None:
+        """The track of a search. None if this tier does not know it, so the next ones are tried
+
+        Raises:
+            ce.YTDLError: When the search cannot be resolved by this tier.
+        """
+
+
+class MemoryCacheTier(ResolverTier):
+    """Fresh entries of the memory tier of the audio cache
+
+    Only the hits are counted in the stats of the cache. A miss or a stale entry is counted by the lookup of the YTDLResolver that follows.
+    """
+
+    name = 'memory'
+
+    def __init__(self, resolver: ar.YTDLResolver, budget: float = 0.005) -> None:
+        super().__init__(budget)
+        self.resolver = resolver
+
+    async def lookup(self, search: str, bitrate: int | None) -> ti.TrackInfo | None:
+        return self._track(self.resolver.cache.get(search, disk=False, count=False), bitrate)
+
+    def _track(self, lookup: ac.CacheLookup, bitrate: int | None) -> ti.TrackInfo | None:
+        # A stale entry needs yt-dlp for its stream url. The YTDLTier takes care of it
+        if lookup.state is not ac.CacheState.FRESH:
+            return None
+        self.resolver.cache.count(lookup)
+        info = lookup.info if bitrate is None else self.resolver.with_format(lookup.info, ar.bitrate_tier(bitrate))
+        return ti.TrackInfo.from_info(info)
+
+
+class DiskCacheTier(MemoryCacheTier):
+    """Fresh entries of the on-disk tier of the audio cache. Read on a thread, so a slow disk never blocks the event loop"""
+
+    name = 'disk'
+
+    def __init__(self, resolver: ar.YTDLResolver, budget: float = 0.15) -> None:
+        super().__init__(resolver, budget)
+
+    async def lookup(self, search: str, bitrate: int | None) -> ti.TrackInfo | None:
+        lookup = await asyncio.get_running_loop().run_in_executor(None, functools.partial(self.resolver.cache.get, search, count=False))
+        return self._track(lookup, bitrate)
+
+
+class LibraryTier(ResolverTier):
+    """Files of the local library that a search names exactly"""
+
+    name = 'library'
+
+    def __init__(self, library: ll.LocalLibrary, budget: float = 0.05) -> None:
+        super().__init__(budget)
+        self.library = library
+
+    async def lookup(self, search: str, bitrate: int | None) -> ti.TrackInfo | None:
+        track = self.library.match(search)
+        return self.library.track_info(track) if track is not None else None
+
+
+class YTDLTier(ResolverTier):
+    """yt-dlp, through the YTDLResolver (which also coalesces identical lookups and fills the audio cache)"""
+
+    name = 'yt-dlp'
+
+    def __init__(self, resolver: ar.YTDLResolver, budget: float = 30) -> None:
+        super().__init__(budget)
+        self.resolver = resolver
+
+    async def lookup(self, search: str, bitrate: int | None) -> ti.TrackInfo | None:
+        return ti.TrackInfo.from_info(await self.resolver.resolve(search, bitrate))
+
+
+class HedgedResolver:
+    """Resolve play searches through a chain of tiers, from the cheapest to the most expensive
+
+    A tier is waited alone until its budget runs out. Then the next tier is started as well ("hedged"), without cancelling the slow one.
+    A tier that misses or fails starts the next one right away. The first tier to find the track wins and the other lookups are cancelled.
+    A cancelled yt-dlp lookup keeps running in the YTDLResolver and still fills the audio cache.
+    """
+
+    def __init__(self, tiers: t.Sequence[ResolverTier]) -> None:
+        self.tiers = list(tiers)
+        # The whole chain, as seen by the callers
+        self.stats = TierStats()
+
+    async def resolve(self, search: str, bitrate: int | None = None) -> ti.TrackInfo:
+        """Get the track of a search
+
+        Args:
+            search (str): A URL or name to search
+            bitrate (int | None, optional): The bitrate (bps) of the voice channel, to pick the audio format. Defaults to None.
+
+        Raises:
+            ce.YTDLError: When no tier could resolve the search.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            track = await self._resolve(search, bitrate)
+        except Exception:
+            self.stats.record('errors', loop.time() - started)
+            raise
+        self.stats.record('hits', loop.time() - started)
+        return track
+
+    @property
+    def summary(self) -> dict[str, dict[str, float | None]]:
+        """The stats of every tier and of the whole chain ("total")"""
+        summary = {tier.name: tier.stats.summary for tier in self.tiers}
+        summary['total'] = self.stats.summary
+        return summary
+
+    async def _resolve(self, search: str, bitrate: int | None) -> ti.TrackInfo:
+        loop = asyncio.get_running_loop()
+        pending: dict[asyncio.Task[ti.TrackInfo | None], tuple[int, float]] = {}
+        next_tier = 0
+        hedge_at = loop.time()
+        error: Exception | None = None
+        try:
+            while True:
+                # Start the next tier when nothing is running anymore or the running ones are over budget
+                if next_tier < len(self.tiers) and (not pending or loop.time() >= hedge_at):
+                    tier = self.tiers[next_tier]
+                    pending[asyncio.create_task(tier.lookup(search, bitrate))] = (next_tier, loop.time())
+                    hedge_at = loop.time() + tier.budget
+                    next_tier += 1
+                if not pending:
+                    break
+
+                wait = max(0.0, hedge_at - loop.time()) if next_tier < len(self.tiers) else None
+                done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                # The cheapest tier wins a tie
+                for task in sorted(done, key=lambda task: pending[task][0]):
+                    index, tier_started = pending.pop(task)
+                    tier = self.tiers[index]
+                    latency = loop.time() - tier_started
+                    if (exception := task.exception()) is not None:
+                        tier.stats.record('errors', latency)
+                        logger.debug(f'The {tier.name} resolver failed on "{search}": {exception}')
+                        error = exception
+                        hedge_at = loop.time()
+                    elif (track := task.result()) is None:
+                        tier.stats.record('misses', latency)
+                        hedge_at = loop.time()
+                    else:
+                        tier.stats.record('hits', latency)
+                        return track
+        finally:
+            for task, (index, _) in pending.items():
+                task.cancel()
+                self.tiers[index].stats.record('cancelled')
+
+        if error is not None:
+            raise error
+        raise ce.YTDLError(f'Couldn\'t find anything that matches "{search}"')
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import typing as t
+from pathlib import Path
+
+import discord
+
+import rate_limits as rl
+
+logger = logging.getLogger(__name__)
+
+
+class RoleChange(t.NamedTuple):
+    member_id: int
+    role_id: int
+    # Whether the role is added. If not, it is removed
+    add: bool
+
+
+def plan_changes(members: t.Iterable[discord.Member], desired: t.Mapping[int, t.Collection[discord.Role]], managed: t.Collection[discord.Role]) -> tuple[list[RoleChange], int]:
+    """The role changes that give every member its desired managed roles, and the amount of members that already have them
+
+    Bots are skipped. Members missing from "desired" must not have any managed role.
+
+    Args:
+        members (t.Iterable[discord.Member]): The members of the guild.
+        desired (t.Mapping[int, t.Collection[discord.Role]]): The managed roles each member (by id) must have.
+        managed (t.Collection[discord.Role]): The roles the plan adds and removes. Other roles are left alone.
+    """
+    managed_ids = {role.id for role in managed}
+    changes = []
+    unchanged = 0
+    for member in members:
+        if member.bot:
+            continue
+        wanted = {role.id for role in desired.get(member.id, ())}
+        current = {role.id for role in member.roles if role.id in managed_ids}
+        if wanted == current:
+            if wanted:
+                unchanged += 1
+            continue
+        changes.extend(RoleChange(member.id, role_id, True) for role_id in wanted - current)
+        changes.extend(RoleChange(member.id, role_id, False) for role_id in current - wanted)
+    return changes, unchanged
+
+
+class AssignmentJob:
+    """The pending role changes of a guild, and how many of them were done"""
+
+    def __init__(self, guild_id: int, changes: t.Iterable[RoleChange], total: int | None = None, done: int = 0, skipped: int = 0, failed: int = 0) -> None:
+        self.guild_id = guild_id
+        self.pending: collections.deque[RoleChange] = collections.deque(changes)
+        # A resumed job counts the changes done before the interruption
+        self.total = total if total is not None else len(self.pending)
+        self.done = done
+        # The member left or the role was deleted
+        self.skipped = skipped
+        self.failed = failed
+
+    @property
+    def processed(self) -> int:
+        return self.done + self.skipped + self.failed
+
+    @property
+    def finished(self) -> bool:
+        return not self.pending
+
+    def to_json(self) -> dict:
+        return {'changes': [list(change) for change in self.pending], 'total': self.total, 'done': self.done, 'skipped': self.skipped, 'failed': self.failed}
+
+    @classmethod
+    def from_json(cls, guild_id: int, data: dict) -> AssignmentJob:
+        return cls(guild_id, (RoleChange(*change) for change in data['changes']), data['total'], data['done'], data.get('skipped', 0), data.get('failed', 0))
+
+
+ProgressCallback = t.Callable[[AssignmentJob], t.Awaitable[None]]
+
+
+class RoleAssigner:
+    """Add and remove roles of many members, with bounded concurrency and within the rate limit of the member roles routes
+
+    There is a job per guild. Starting a job replaces the previous one of the guild.
+    Unfinished jobs are checkpointed to a file (while they run and when they are interrupted), so they can be resumed after a restart.
+    """
+
+    def __init__(self, http: discord.http.HTTPClient, path: Path | str | None = None, concurrency: int = 4, reserve: int = 1) -> None:
+        """
+        Args:
+            http (discord.http.HTTPClient): The HTTP client of the bot.
+            path (Path | str | None, optional): The checkpoint file of the unfinished jobs. If None, they are not persisted. Defaults to None.
+            concurrency (int, optional): Maximum role changes of a job in flight. Defaults to 4.
+            reserve (int, optional): Requests of each rate limit window left to other commands. Defaults to 1.
+        """
+        self.http = http
+        self.path = Path(path) if path is not None else None
+        self.concurrency = concurrency
+        self.reserve = reserve
+        self.jobs: dict[int, AssignmentJob] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._in_flight: collections.Counter[int] = collections.Counter()
+        self._dirty = False
+
+    async def run(self, job: AssignmentJob, report: ProgressCallback | None = None, report_interval: float = 3.0) -> AssignmentJob:
+        """Run a job until it finishes. Replaces the running job of its guild, if any
+
+        Args:
+            job (AssignmentJob): The job to run.
+            report (ProgressCallback | None, optional): Awaited with the job every "report_interval" seconds and at the end. Defaults to None.
+            report_interval (float, optional): Seconds between two reports. Defaults to 3.0.
+        """
+        self.discard(job.guild_id)
+        self.jobs[job.guild_id] = job
+        self._dirty = True
+        workers = {asyncio.create_task(self._worker(job)) for _ in range(min(self.concurrency, len(job.pending)))}
+        self._tasks[job.guild_id] = task = asyncio.current_task()
+        try:
+            while workers:
+                _, workers = await asyncio.wait(workers, timeout=report_interval)
+                self.save()
+                if report is not None:
+                    with contextlib.suppress(discord.HTTPException):
+                        await report(job)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            # Wait for the cancelled workers to put their changes back
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self._tasks.get(job.guild_id) is task:
+                del self._tasks[job.guild_id]
+            if job.finished and self.jobs.get(job.guild_id) is job:
+                del self.jobs[job.guild_id]
+            self._dirty = True
+            self.save()
+        return job
+
+    def discard(self, guild_id: int) -> AssignmentJob | None:
+        """Stop the job of a guild for good. It is not resumed"""
+        job = self.jobs.pop(guild_id, None)
+        if (task := self._tasks.pop(guild_id, None)) is not None and task is not asyncio.current_task():
+            task.cancel()
+        if job is not None:
+            self._dirty = True
+            self.save()
+        return job
+
+    async def close(self) -> None:
+        """Interrupt the running jobs. They are checkpointed, so they can be resumed"""
+        tasks = [task for task in self._tasks.values() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dirty = True
+        self.save()
+
+    def load(self) -> list[AssignmentJob]:
+        """The unfinished jobs of the checkpoint file"""
+        if self.path is None:
+            return []
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as error:
+            logger.warning(f'Failed to load the role assignment jobs from "{self.path}": {error}')
+            return []
+        return [AssignmentJob.from_json(int(guild_id), job) for guild_id, job in data.items()]
+
+    def save(self) -> None:
+        """Checkpoint the unfinished jobs, if they changed. The file is replaced atomically"""
+        if self.path is None or not self._dirty:
+            return
+        data = {str(guild_id): job.to_json() for guild_id, job in self.jobs.items() if not job.finished}
+        temporary = self.path.with_suffix('.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(temporary, 'w', encoding='utf-8') as file:
+                json.dump(data, file, separators=(',', ':'))
+            os.replace(temporary, self.path)
+        except OSError as error:
+            logger.warning(f'Failed to save the role assignment jobs to "{self.path}": {error}')
+            return
+        self._dirty = False
+
+    async def _worker(self, job: AssignmentJob) -> None:
+        while job.pending:
+            change = job.pending.popleft()
+            self._dirty = True
+            try:
+                await self._wait_for_budget(job.guild_id, change.add)
+                self._in_flight[job.guild_id] += 1
+                try:
+                    if change.add:
+                        await self.http.add_role(job.guild_id, change.member_id, change.role_id, reason='Rave')
+                    else:
+                        await self.http.remove_role(job.guild_id, change.member_id, change.role_id, reason='Rave')
+                finally:
+                    self._in_flight[job.guild_id] -= 1
+            except asyncio.CancelledError:
+                # Adding or removing a role twice is harmless. Do it again when the job is resumed
+                job.pending.appendleft(change)
+                raise
+            except discord.NotFound:
+                job.skipped += 1
+            except discord.HTTPException as error:
+                logger.info(f'Failed to change the role {change.role_id} of the member {change.member_id}: {error}')
+                job.failed += 1
+            else:
+                job.done += 1
+
+    async def _wait_for_budget(self, guild_id: int, add: bool) -> None:
+        # Wait for the window to reset instead of piling requests up in the discord.py bucket, where they would delay other commands
+        route = discord.http.Route('PUT' if add else 'DELETE', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}', guild_id=guild_id, user_id=0, role_id=0)
+        while (state := rl.route_bucket(self.http, route)) is not None and state.reset_after:
+            if state.remaining - self.reserve - self._in_flight[guild_id] > 0:
+                return
+            await asyncio.sleep(state.reset_after)
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import gzip
+import heapq
+import json
+import logging
+import os
+import time
+import unicodedata
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+GRAM_SIZE = 3
+
+
+class IndexedTrack:
+    __slots__ = ('url', 'title', 'key', 'plays', 'last_played')
+
+    def __init__(self, url: str, title: str, plays: int = 0, last_played: float = 0.0) -> None:
+        self.url = url
+        self.title = title
+        # The normalized text that is searched
+        self.key = TrackIndex.normalize(f'{title} {url.split("://", 1)[-1]}')
+        self.plays = plays
+        self.last_played = last_played
+
+
+class TrackIndex:
+    """In-memory n-gram index of the tracks already resolved by the bot. Used to autocomplete searches without network calls
+
+    Every trigram of a track text (its title and url) points to the tracks that contain it.
+    A query is answered by intersecting the trigrams of its words and checking the few remaining candidates.
+    Only the url, the title and the play count of each track are persisted (gzipped JSON). The trigrams are rebuilt on load.
+    """
+
+    def __init__(self, path: Path | str | None = None, max_tracks: int = 5000) -> None:
+        """
+        Args:
+            path (Path | str | None, optional): The file where the index is persisted. If None, it is not persisted. Defaults to None.
+            max_tracks (int, optional): Maximum amount of tracks. The least played ones are evicted. Defaults to 5000.
+        """
+        self.path = Path(path) if path is not None else None
+        self.max_tracks = max_tracks
+        self.dirty = False
+        self._tracks: dict[str, IndexedTrack] = {}
+        self._grams: dict[str, set[IndexedTrack]] = {}
+        if self.path is not None:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def add(self, url: str, title: str) -> None:
+        """Add a resolved track or count a new play of it"""
+        track = self._tracks.get(url)
+        if track is None or track.title != title:
+            plays = track.plays if track is not None else 0
+            if track is not None:
+                self._unindex(track)
+            elif len(self._tracks) >= self.max_tracks:
+                self._evict()
+            track = IndexedTrack(url, title, plays)
+            self._index(track)
+        track.plays += 1
+        track.last_played = time.time()
+        self.dirty = True
+
+    def search(self, query: str, limit: int = 25) -> list[IndexedTrack]:
+        """The best tracks that contain every word of the query. The most played first, preferring the ones that start with the query"""
+        query = self.normalize(query)
+        if not query:
+            candidates = self._tracks.values()
+        else:
+            words = query.split()
+            grams = {gram for word in words for gram in self.grams(word)}
+            if grams:
+                postings = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                # Too short to have trigrams. Only a few thousands of short strings to check
+                candidates = self._tracks.values()
+            candidates = [track for track in candidates if all(word in track.key for word in words)]
+        return heapq.nlargest(limit, candidates, key=lambda track: (track.key.startswith(query), track.plays, track.last_played))
+
+    def load(self) -> None:
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+                rows = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logger.warning(f'Failed to load the track index from "{self.path}": {error}')
+            return
+        for url, title, plays, last_played in rows[:self.max_tracks]:
+            track = IndexedTrack(url, title, plays, last_played)
+            self._index(track)
+        logger.info(f'Loaded {len(self._tracks)} tracks into the track index')
+
+    def save(self) -> None:
+        """Write the index to its file, if it changed. The file is replaced atomically"""
+        if self.path is None or not self.dirty:
+            return
+        # May run on an executor thread while tracks are added on the event loop. Copying the values is atomic,
+        # and the tracks added from now on mark the index dirty again for the next save
+        self.dirty = False
+        rows = [[track.url, track.title, track.plays, track.last_played] for track in list(self._tracks.values())]
+        temporary = self.path.with_suffix('.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(temporary, 'wt', encoding='utf-8') as file:
+                json.dump(rows, file, separators=(',', ':'), ensure_ascii=False)
+            os.replace(temporary, self.path)
+        except OSError as error:
+            logger.warning(f'Failed to save the track index to "{self.path}": {error}')
+            self.dirty = True
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Lowercase, without accents and with single spaces"""
+        text = unicodedata.normalize('NFKD', text.casefold())
+        return ' '.join(''.join(char for char in text if not unicodedata.combining(char)).split())
+
+    @staticmethod
+    def grams(text: str) -> set[str]:
+        return {text[index:index + GRAM_SIZE] for index in range(len(text) - GRAM_SIZE + 1)}
+
+    def _index(self, track: IndexedTrack) -> None:
+        self._tracks[track.url] = track
+        for gram in self.grams(track.key):
+            self._grams.setdefault(gram, set()).add(track)
+
+    def _unindex(self, track: IndexedTrack) -> None:
+        del self._tracks[track.url]
+        for gram in self.grams(track.key):
+            posting = self._grams.get(gram)
+            if posting is not None:
+                posting.discard(track)
+                if not posting:
+                    del self._grams[gram]
+
+    def _evict(self) -> None:
+        # Make room for a tenth of the tracks at once, so evictions are rare
+        for track in heapq.nsmallest(max(1, self.max_tracks // 10), self._tracks.values(), key=lambda track: (track.plays, track.last_played)):
+            self._unindex(track)
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import sys
+import typing as t
+
+
+def _intern(value: t.Any) -> str | None:
+    # Many tracks share the same uploader or codec. Keep a single copy of those strings
+    return sys.intern(value) if isinstance(value, str) else None
+
+
+class TrackInfo:
+    """The metadata of a resolved track that the queue and the embeds use
+
+    Built from a yt-dlp info dict, which can be dropped afterwards.
+    A slotted object takes a fraction of the memory of the dict (without "formats" and the other heavy keys) it replaces.
+    """
+
+    __slots__ = (
+        'title',
+        'webpage_url',
+        'stream_url',
+        'duration',
+        'uploader',
+        'uploader_url',
+        'thumbnail',
+        'acodec',
+        'gain',
+    )
+
+    def __init__(self,
+            title: str,
+            webpage_url: str,
+            stream_url: str,
+            duration: int = 0,
+            uploader: str | None = None,
+            uploader_url: str | None = None,
+            thumbnail: str | None = None,
+            acodec: str | None = None,
+            gain: float = 1.0,
+    ) -> None:
+        self.title = title
+        self.webpage_url = webpage_url
+        # The url FFmpeg reads. It may expire (see AudioCache.stream_expiry)
+        self.stream_url = stream_url
+        # In seconds. 0 when unknown (e.g. live streams)
+        self.duration = duration
+        self.uploader = _intern(uploader)
+        self.uploader_url = _intern(uploader_url)
+        self.thumbnail = thumbnail
+        self.acodec = _intern(acodec)
+        # Loudness normalization gain (see LoudnessAnalyzer). 1.0 until it is measured
+        self.gain = gain
+
+    @classmethod
+    def from_info(cls, info: dict) -> TrackInfo:
+        """Build a TrackInfo from a resolved yt-dlp info dict"""
+        return cls(
+            title=info.get('title') or info.get('webpage_url') or info['url'],
+            webpage_url=info.get('webpage_url') or info['url'],
+            stream_url=info['url'],
+            duration=int(info.get('duration') or 0),
+            uploader=info.get('uploader') or info.get('channel'),
+            uploader_url=info.get('uploader_url') or info.get('channel_url'),
+            thumbnail=info.get('thumbnail'),
+            acodec=info.get('acodec'),
+        )
+
+    @property
+    def codec(self) -> str | None:
+        """The audio codec of the stream. yt-dlp already probed it, so FFmpeg does not need to probe it again"""
+        if self.acodec in (None, 'none'):
+            return None
+        # e.g. "opus" or "mp4a.40.2"
+        return self.acodec.split('.')[0]
+
+    @property
+    def is_local(self) -> bool:
+        """Whether the stream is a local file (see LocalLibrary). Local files never expire and need no reconnect options"""
+        return '://' not in self.stream_url
+
+    @property
+    def memory_size(self) -> int:
+        """Approximate amount of bytes the track keeps alive. Interned strings are shared, so they are not counted"""
+        size = sys.getsizeof(self)
+        for name in ('title', 'webpage_url', 'stream_url', 'thumbnail'):
+            size += sys.getsizeof(getattr(self, name))
+        return size
+
+    def __repr__(self) -> str:
+        return f'<TrackInfo title={self.title!r} webpage_url={self.webpage_url!r}>'
@@ -0,0 +1,61 @@
+"""Functions that run yt-dlp extractions on executor threads or on worker processes
+
+This module is imported by every worker process of the process pool backend. Keep its imports light.
+"""
+from __future__ import annotations
+
+import threading
+
+# import youtube_dl
+import yt_dlp as youtube_dl
+
+import audio_cache as ac
+
+_local = threading.local()
+
+
+def init_worker(ytdl_options: dict) -> None:
+    """Warm up a worker process. The yt-dlp modules are imported and a YoutubeDL is ready before the first job arrives"""
+    _get_ytdl(ytdl_options)
+
+
+def ping() -> bool:
+    return True
+
+
+def extract_info(search: str, ytdl_options: dict, process: bool = True) -> tuple[dict | None, str | None]:
+    """Run a YoutubeDL extraction
+
+    Args:
+        search (str): A URL or name to search
+        ytdl_options (dict): Options to pass to YoutubeDL
+        process (bool, optional): Whether to fully process the results. Defaults to True.
+
+    Returns:
+        tuple[dict | None, str | None]: The slim, picklable info dict and an error message.
+            Errors are returned as text because yt-dlp exceptions carry tracebacks that can not be pickled.
+    """
+    try:
+        info = _get_ytdl(ytdl_options).extract_info(search, download=False, process=process)
+    except youtube_dl.utils.DownloadError as error:
+        return None, str(error)
+    if info is None:
+        return None, None
+    info = youtube_dl.YoutubeDL.sanitize_info(info)
+    return slim_info(info), None
+
+
+def slim_info(info: dict) -> dict:
+    info = ac.AudioCache.slim(info)
+    if isinstance(info.get('entries'), list):
+        info['entries'] = [slim_info(entry) if entry else entry for entry in info['entries']]
+    return info
+
+
+def _get_ytdl(ytdl_options: dict) -> youtube_dl.YoutubeDL:
+    # YoutubeDL objects are not thread safe. Keep one per thread and per options
+    ytdls: dict[str, youtube_dl.YoutubeDL] = _local.__dict__.setdefault('ytdls', {})
+    key = repr(sorted(ytdl_options.items()))
+    if (ytdl := ytdls.get(key)) is None:
+        ytdl = ytdls[key] = youtube_dl.YoutubeDL(ytdl_options)
+    return ytdl